@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/19 下午 08:40
+
+import functools
+from collections import deque
+
+
+class Automaton(object):
+    """
+    Aho-Corasick 多模式匹配：一次扫描文本找出所有模式串的所有出现位置
+        automaton = Automaton(['广州', '广州白云国际机场'])
+        automaton.search('到达广州白云国际机场') -> [(2, 10, 1)]
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        # goto[state]: 字 -> 下一个状态；fail[state]: 失配时跳转的状态；output[state]: 在该状态结束的模式下标
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for idx, pattern in enumerate(self.patterns):
+            if pattern == '':
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                state = next_state
+            self.output[state].append(idx)
+        self._build_fail()
+
+    def _build_fail(self):
+        """按层次遍历构造失配指针，并把失配状态的输出合并到当前状态"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def iter_matches(self, text):
+        """产出所有匹配 (start, end, 模式下标)，end 不含，按 end 递增"""
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for idx in self.output[state]:
+                yield i + 1 - len(self.patterns[idx]), i + 1, idx
+
+    def search(self, text):
+        """
+        不重叠的匹配 [(start, end, 模式下标), ...]，按位置排序：
+        从左到右取匹配，同一起点取最长的模式，与已选匹配重叠的丢弃
+        """
+        matches = sorted(self.iter_matches(text), key=lambda match: (match[0], match[0] - match[1]))
+        selected = []
+        last_end = 0
+        for start, end, idx in matches:
+            if start >= last_end:
+                selected.append((start, end, idx))
+                last_end = end
+        return selected
+
+
+@functools.lru_cache(maxsize=256)
+def get_automaton(patterns):
+    """patterns: tuple，同一组模型输出只构造一次自动机"""
+    return Automaton(patterns)
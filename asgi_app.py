@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/20 下午 03:30
+
+import json
+import asyncio
+
+import config
+from batcher import DynamicBatcher, QueueFull, DeadlineExceeded
+from flask_predict import PredictModel
+from new_ner_flask import parse_record, build_ner_rows
+import model_registry
+
+
+class NerAsgiApp(object):
+    """
+    与 NerApp 接口相同的 ASGI 前端（POST /NER, GET /nerstats, GET /nerhome），例如：
+        uvicorn asgi_app:app --workers 1
+    事件循环只负责收发请求，推理交给 DynamicBatcher 的后台线程合并成batch；
+    队列满时返回429，超过 config.request_timeout 秒未完成返回503，慢请求不会阻塞其它请求
+    """
+
+    def __init__(self, predict_model=None, batcher=None):
+        self.predict_model = predict_model or PredictModel()
+        self.batcher = batcher or DynamicBatcher(self.predict_model)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        path, method = scope['path'], scope['method']
+        if path == '/nerhome':
+            return await self.send_text(send, 200, 'Welcome to use ner', 'text/html; charset=utf-8')
+        if path == '/nerstats' and method == 'GET':
+            stats = {'models': model_registry.model_stats(), 'batcher': self.batcher.stats()}
+            if self.predict_model.cache is not None:
+                stats['cache'] = self.predict_model.cache.stats()
+            return await self.send_json(send, 200, {'code': 1, 'msg': "执行成功", 'data': stats})
+        if path == '/NER' and method == 'POST':
+            return await self.ner(receive, send)
+        return await self.send_json(send, 404, {'code': 0, 'msg': "not found", 'data': []})
+
+    async def ner(self, receive, send):
+        body = await self.read_body(receive)
+        try:
+            records = [parse_record(record) for record in json.loads(body)]
+        except (ValueError, AttributeError, TypeError):
+            return await self.send_json(send, 400, {'code': 0, 'msg': "请求格式错误", 'data': []})
+
+        # 空文本不进入模型
+        contents = [record['travelContent'] for record in records if record['travelContent'] != ""]
+        predicts = []
+        if contents:
+            try:
+                future = self.batcher.submit(contents)
+            except QueueFull:
+                return await self.send_json(send, 429, {'code': 0, 'msg': "服务繁忙，请稍后重试", 'data': []})
+            try:
+                predicts = await asyncio.wait_for(asyncio.wrap_future(future), config.request_timeout)
+            except (asyncio.TimeoutError, DeadlineExceeded):
+                future.cancel()
+                return await self.send_json(send, 503, {'code': 0, 'msg': "请求超时", 'data': []})
+
+        predicts = iter(predicts)
+        ners = []
+        for record in records:
+            predict_ = next(predicts) if record['travelContent'] != "" else None
+            ners.extend(build_ner_rows(record, predict_))
+        return await self.send_json(send, 200, {'code': 1, 'msg': "执行成功", 'data': ners})
+
+    @staticmethod
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def read_body(receive):
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    @staticmethod
+    async def send_text(send, status, text, content_type):
+        body = text.encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type.encode('latin-1')),
+                                (b'content-length', str(len(body)).encode('latin-1'))]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_json(self, send, status, data):
+        await self.send_text(send, status, json.dumps(data), 'application/json')
+
+
+app = NerAsgiApp()
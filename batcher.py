@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/18 上午 10:12
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+
+import config
+from segment import segment
+
+
+class QueueFull(Exception):
+    """等待推理的任务数达到 config.max_queue_size，接口返回429"""
+
+
+class DeadlineExceeded(Exception):
+    """任务在 config.request_timeout 秒内没有完成，接口返回503"""
+
+
+class DynamicBatcher(object):
+    """
+    跨请求的动态批处理：
+        1. 每个请求把自己的全部 travelContent 作为一个任务放入有界队列，队列满时直接拒绝（QueueFull）
+        2. 后台线程在 config.batch_wait_ms 的等待窗口内合并多个任务，
+           凑够 config.batch_size 个chunk（或窗口到期）后统一交给 PredictModel.predict_batch，
+           已经超过截止时间或被调用方取消的任务不进入模型
+        3. 结果按任务拆分后写回各自的 Future；batch 出错时逐个任务重试，只有出错的任务收到异常
+    """
+
+    def __init__(self, predict_model, batch_size=None, wait_ms=None, max_queue_size=None, timeout=None):
+        self.predict_model = predict_model
+        self.batch_size = batch_size or config.batch_size
+        self.wait_ms = config.batch_wait_ms if wait_ms is None else wait_ms
+        self.max_queue_size = config.max_queue_size if max_queue_size is None else max_queue_size
+        self.timeout = config.request_timeout if timeout is None else timeout
+        self.queue = queue.Queue(self.max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        # 统计：被拒绝/超时的任务数，任务从提交到进入模型的等待时间（最近1000个）
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.max_depth = 0
+        self.wait_times = deque(maxlen=1000)
+
+    def predict_many(self, contents, timeout=None):
+        """阻塞直到 contents 的全部结果返回，顺序与 contents 一致；超时抛出 DeadlineExceeded"""
+        if len(contents) == 0:
+            return []
+        timeout = self.timeout if timeout is None else timeout
+        future = self.submit(contents, timeout)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise DeadlineExceeded("request not finished in {}s".format(timeout))
+
+    def submit(self, contents, timeout=None):
+        """放入队列并返回 Future，队列已满时抛出 QueueFull；超过 timeout 秒仍未开始推理的任务会被丢弃"""
+        self._ensure_worker()
+        future = Future()
+        now = time.monotonic()
+        deadline = now + (self.timeout if timeout is None else timeout)
+        try:
+            self.queue.put_nowait((list(contents), future, now, deadline))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull("inference queue is full ({} tasks)".format(self.max_queue_size))
+        with self._lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+        return future
+
+    def stats(self):
+        with self._lock:
+            wait_ms = np.array(self.wait_times) * 1000
+            return {'queue_depth': self.queue.qsize(), 'max_queue_size': self.max_queue_size,
+                    'max_depth': self.max_depth, 'submitted': self.submitted, 'rejected': self.rejected,
+                    'expired': self.expired,
+                    'wait_ms': {'mean': float(wait_ms.mean()) if len(wait_ms) else 0.0,
+                                'p95': float(np.percentile(wait_ms, 95)) if len(wait_ms) else 0.0,
+                                'max': float(wait_ms.max()) if len(wait_ms) else 0.0}}
+
+    def _ensure_worker(self):
+        # 线程不会被fork继承，子进程中需要重新拉起
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self.queue = queue.Queue(self.max_queue_size)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name='ner-batcher', daemon=True)
+                self._thread.start()
+
+    @staticmethod
+    def _num_chunks(contents):
+        """与 GetData 相同的切分规则（config.max_segment_len）估算进入模型的chunk数"""
+        return sum(max(len(segment(content.strip())), 1) for content in contents)
+
+    def _accept(self, task):
+        """任务已被取消或超过截止时间时丢弃，否则标记为运行中并记录等待时间"""
+        _, future, submitted, deadline = task
+        now = time.monotonic()
+        if not future.set_running_or_notify_cancel():
+            # 调用方等待超时后已经取消
+            with self._lock:
+                self.expired += 1
+            return False
+        if now > deadline:
+            with self._lock:
+                self.expired += 1
+            future.set_exception(DeadlineExceeded("request waited {:.3f}s in queue".format(now - submitted)))
+            return False
+        with self._lock:
+            self.wait_times.append(now - submitted)
+        return True
+
+    def _task_chunks(self, task):
+        """任务的chunk数；内容无法切分时只让该任务失败，返回None，后台线程继续运行"""
+        try:
+            return self._num_chunks(task[0])
+        except Exception as e:
+            logging.exception("--------Invalid task dropped!--------")
+            task[1].set_exception(e)
+            return None
+
+    def _collect(self):
+        """阻塞取第一个有效任务，然后在等待窗口内继续合并，直到凑满一个batch"""
+        num_chunks = None
+        while num_chunks is None:
+            task = self.queue.get()
+            if self._accept(task):
+                num_chunks = self._task_chunks(task)
+        tasks = [task]
+        deadline = time.monotonic() + self.wait_ms / 1000.0
+        while num_chunks < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                task = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if not self._accept(task):
+                continue
+            task_chunks = self._task_chunks(task)
+            if task_chunks is None:
+                continue
+            tasks.append(task)
+            num_chunks += task_chunks
+        return tasks
+
+    def _loop(self):
+        while True:
+            tasks = self._collect()
+            contents = [content for task_contents, _, _, _ in tasks for content in task_contents]
+            try:
+                results = self.predict_model.predict_batch(contents)
+            except Exception as e:
+                logging.exception("--------Batch predict failed!--------")
+                if len(tasks) == 1:
+                    tasks[0][1].set_exception(e)
+                    continue
+                results = None
+            if results is None:
+                # 合并的batch出错时逐个任务重新预测，只有出错的任务收到异常，不影响同batch的其它请求
+                self._predict_each(tasks)
+                continue
+            logging.info("--------Batch predict: {} tasks, {} records--------".format(len(tasks), len(contents)))
+            start = 0
+            for task_contents, future, _, _ in tasks:
+                future.set_result(results[start:start + len(task_contents)])
+                start += len(task_contents)
+
+    def _predict_each(self, tasks):
+        for task_contents, future, _, _ in tasks:
+            try:
+                results = self.predict_model.predict_batch(task_contents)
+            except Exception as e:
+                logging.exception("--------Task predict failed!--------")
+                future.set_exception(e)
+                continue
+            future.set_result(results)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/20 下午 07:45
+
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+import logging
+import multiprocessing
+
+import torch
+
+import config
+
+MANIFEST_FILE = 'manifest.json'
+# 输出字段 -> (PredictModel.predict_spans 中的模型下标, label)，与 new_ner_flask.build_ner_rows 一致
+FIELDS = [('travelTime', 1, 'date'), ('digPersonName', 0, 'name'),
+          ('digPlaceName', 1, 'location'), ('digTrafficTool', 0, 'license')]
+ID_FIELDS = ('eventId', 'caseId', 'sourceId')
+
+# worker 进程中的 PredictModel
+_predict_model = None
+
+
+def iter_input(path, input_format=None):
+    """逐条读取 JSONL 或 CSV（带表头）记录，格式默认按扩展名判断"""
+    input_format = input_format or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if input_format == 'csv':
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def count_input(path, input_format=None):
+    """记录总数，用于估算剩余时间"""
+    return sum(1 for _ in iter_input(path, input_format))
+
+
+def part_path(output_dir, shard):
+    return os.path.join(output_dir, 'part-{:05d}.jsonl'.format(shard))
+
+
+def check_manifest(output_dir, args):
+    """
+    输出目录中记录输入文件和分片大小，续跑时必须一致，否则已完成的分片与新的划分对不上
+    """
+    manifest = {'input': os.path.abspath(args.input), 'input_size': os.path.getsize(args.input),
+                'input_mtime': os.path.getmtime(args.input), 'shard_size': args.shard_size}
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            previous = json.load(f)
+        if previous != manifest:
+            raise ValueError("{} was written for a different input or shard size, "
+                             "use a new output_dir".format(output_dir))
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+
+def init_worker(threads):
+    global _predict_model
+    from flask_predict import PredictModel
+
+    torch.set_num_threads(threads)
+    _predict_model = PredictModel()
+
+
+def build_output(record, spans):
+    """一条记录的输出：id字段、各字段的实体文本、以及实体在 travelContent 中的位置"""
+    output = {key: record.get(key, "") for key in ID_FIELDS}
+    entities = []
+    for field, model_idx, label in FIELDS:
+        matched = [span for span in spans[model_idx] if span[0] == label]
+        output[field] = [text for _, _, _, text in matched]
+        entities.extend({'label': span[0], 'start': span[1], 'end': span[2], 'text': span[3]} for span in matched)
+    output['entities'] = sorted(entities, key=lambda entity: entity['start'])
+    return output
+
+
+def predict_shard(shard, records, output_dir, batch_size):
+    """预测一个分片并写到 part-xxxxx.jsonl：先写临时文件，完成后改名，改名后的文件即为该分片的检查点"""
+    path = part_path(output_dir, shard)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            contents = [record.get('travelContent') or "" for record in batch]
+            spans = _predict_model.predict_spans(contents)
+            for record, record_spans in zip(batch, spans):
+                f.write(json.dumps(build_output(record, record_spans), ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+    return shard, len(records)
+
+
+def _predict_shard(task):
+    return predict_shard(*task)
+
+
+def finished_shards(output_dir, total, shard_size):
+    """续跑时已经有输出文件的分片，以及其中的记录数（分片按 manifest 中的 shard_size 划分）"""
+    shards = {shard for shard in range(-(-total // shard_size)) if os.path.exists(part_path(output_dir, shard))}
+    return shards, sum(min(shard_size, total - shard * shard_size) for shard in shards)
+
+
+def iter_tasks(args, finished):
+    """按 shard_size 切分输入，跳过 finished 中已经完成的分片"""
+    records = iter_input(args.input, args.format)
+    for shard in itertools.count():
+        chunk = list(itertools.islice(records, args.shard_size))
+        if not chunk:
+            return
+        if shard in finished:
+            continue
+        yield shard, chunk, args.output_dir, args.batch_size
+
+
+def run(args):
+    check_manifest(args.output_dir, args)
+    total = count_input(args.input, args.format)
+    finished, resumed = finished_shards(args.output_dir, total, args.shard_size)
+    tasks = iter_tasks(args, finished)
+    logging.info("--------{} records ({} resumed from {} shards), {} workers, output to {}--------".format(
+        total, resumed, len(finished), args.workers, args.output_dir))
+
+    if args.workers <= 1:
+        init_worker(args.threads)
+        results = map(_predict_shard, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.threads,))
+        # imap 会一次读完全部任务，这里每次只提交 2 * workers 个分片，内存与输入大小无关
+        results = (result for window in iter_window(tasks, 2 * args.workers)
+                   for result in pool.imap_unordered(_predict_shard, window))
+
+    start = time.time()
+    done = 0
+    try:
+        for shard, num_records in results:
+            done += num_records
+            elapsed = time.time() - start
+            speed = done / max(elapsed, 1e-6)
+            remaining = total - resumed - done
+            logging.info("shard {} done: {}/{} records ({} resumed), {:.1f} records/s, ETA {:.0f}s".format(
+                shard, resumed + done, total, resumed, speed, remaining / speed if speed > 0 else 0))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logging.info("--------Bulk predict DONE: {} records in {:.1f}s--------".format(done, time.time() - start))
+
+
+def iter_window(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        window = list(itertools.islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='offline NER prediction over JSONL/CSV records')
+    parser.add_argument('input', help='JSONL or CSV file with travelContent (and eventId, caseId, sourceId)')
+    parser.add_argument('output_dir', help='directory for part-xxxxx.jsonl files; rerun to resume')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default=None, help='default: by file extension')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker')
+    parser.add_argument('--shard_size', type=int, default=10000, help='records per output file')
+    parser.add_argument('--batch_size', type=int, default=config.batch_size,
+                        help='records per PredictModel.predict_spans call')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(process)d:%(levelname)s: %(message)s')
+    run(parse_arguments())
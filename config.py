@@ -14,16 +14,52 @@ bert_model = 'pretrained_bert_models/bert-base-chinese/'
 roberta_model = 'pretrained_bert_models/chinese_roberta_wwm_large_ext/'
 model_dir = os.getcwd() + '/experiments/clue/'
 model_dir1 = os.getcwd() + '/experiments/clue1/'
+# 共享编码器的多头模型，heads[k] 对应 model_dir / model_dir1 中第k个模型负责的label
+multi_head_dir = os.getcwd() + '/experiments/clue_multi/'
 log_dir = model_dir + 'train.log'
 log_dir = model_dir1 + 'train.log'
 case_dir = os.getcwd() + '/case/bad_case.txt'
 
+# 文本按句末标点切分后每段的最大长度（不超过511，[CLS]占一个位置）
+max_segment_len = 128
+# 是否把多个短句拼接到同一个序列中（block-diagonal attention），以及拼接后的最大token数
+pack_sequences = False
+max_pack_len = 512
+# 是否按token长度分桶组batch，以及每个桶包含多少个batch
+length_bucketing = True
+bucket_batches = 50
+
+# 是否使用 memory-mapped 二进制语料（Processor 写入 data_dir/<mode>_corpus/，训练时按下标读取）
+mmap_corpus = False
+# 是否流式读取标注文件（JSON数组或JSONL，需配合 mmap_corpus）
+stream_json = False
+# 数据处理的分片大小（记录数）、并行处理的进程数、是否按分片内容缓存处理结果（data_dir/cache/）
+stream_chunk_size = 1000
+preprocess_workers = os.cpu_count() or 1
+preprocess_cache = True
+
 # 训练集、验证集划分比例
 dev_split_size = 0.1
 
 # 是否加载训练好的NER模型
 load_before = False
 
+# 是否使用共享编码器的多头模型（训练和预测）
+multi_head = False
+heads = [['name', 'license'], ['date', 'location']]
+
+# 推理后端：'torch' 或 'onnx'（onnxruntime，需先用 onnx_backend.py export 导出到 model_dir/onnx_dir_name）
+backend = 'torch'
+onnx_dir_name = 'onnx/'
+# 是否加载int8动态量化后的模型（需先用 quantize.py 生成到 model_dir/quantized_dir_name）
+quantized = False
+quantized_dir_name = 'int8/'
+# 量化后dev集f1允许下降的最大值，超过则不建议上线
+max_quantized_f1_drop = 0.005
+
+# CRF解码时是否按BIO规则禁止非法转移（如 O -> I-date）
+bio_constraint = True
+
 # 是否对整个BERT进行fine tuning
 full_fine_tuning = True
 
@@ -33,6 +69,26 @@ weight_decay = 0.01
 clip_grad = 5
 
 batch_size = 32
+# 训练和评估时 DataLoader 组batch的子进程数（0为在主进程中组batch，在线预测始终为0）、是否使用锁页内存（仅GPU）、每个子进程预取的batch数
+num_workers = 0
+pin_memory = True
+prefetch_factor = 2
+# 服务端动态批处理的等待窗口（毫秒），窗口内到达的请求合并成一个batch
+batch_wait_ms = 10
+# 等待推理的请求数上限（超过返回429），以及请求的截止时间（秒，超过返回503）
+max_queue_size = 256
+request_timeout = 30
+# NDJSON 流式接口同时在途的记录数
+stream_window = 64
+# 句子级预测结果缓存：最多缓存的句子数（0为关闭）和过期时间（秒）
+cache_size = 10000
+cache_ttl = 3600
+# 多进程服务（prefork_server）：监听地址、worker进程数、每个worker的torch线程数、是否把worker绑定到固定CPU
+serve_host = '0.0.0.0'
+serve_port = 8989
+serve_workers = 4
+worker_threads = 1
+cpu_affinity = True
 epoch_num = 50
 min_epoch_num = 5
 patience = 0.0002
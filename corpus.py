@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/19 下午 03:10
+
+import os
+import json
+import logging
+
+import numpy as np
+
+import utils
+
+META_FILE = 'meta.json'
+# 文件名 -> dtype，每句的数据在文件中首尾相接，由 *_offsets 索引
+ARRAYS = {'tokens': np.int32,        # 含[CLS]的token id
+          'token_starts': np.int32,  # 每个字对应的token位置
+          'labels': np.int16,        # 每个字的label id
+          'chars': np.uint32,        # 每个字的unicode码位
+          'token_offsets': np.int64,  # 第i句的token在 tokens 中的范围为 [token_offsets[i], token_offsets[i + 1])
+          'char_offsets': np.int64}   # 第i句的字在 token_starts / labels / chars 中的范围
+
+
+class CorpusWriter(object):
+    """
+    把按字切分好的句子和BIO标签逐句追加写入二进制文件，写完后由 Corpus 用 np.memmap 读取：
+        writer = CorpusWriter(corpus_dir, config)
+        writer.add(words, labels)
+        writer.close()
+    meta.json 在 close 时最后写入，没有 meta.json 的目录视为不完整
+    """
+
+    def __init__(self, corpus_dir, config):
+        self.corpus_dir = corpus_dir
+        self.char_vocab = utils.get_char_vocab(config.bert_model)
+        self.label2id = config.label2id
+        self.cls_id = self.char_vocab.tokenizer.convert_tokens_to_ids('[CLS]')
+        os.makedirs(corpus_dir, exist_ok=True)
+        if os.path.exists(os.path.join(corpus_dir, META_FILE)):
+            os.remove(os.path.join(corpus_dir, META_FILE))
+        self.files = {name: open(os.path.join(corpus_dir, name + '.bin'), 'wb') for name in ARRAYS}
+        self.num_sentences = 0
+        self.num_tokens = 0
+        self.num_chars = 0
+        self._write('token_offsets', [0])
+        self._write('char_offsets', [0])
+
+    def _write(self, name, values):
+        self.files[name].write(np.asarray(values, dtype=ARRAYS[name]).tobytes())
+
+    def add(self, words, labels=None):
+        """words: 单字列表，labels: 等长的BIO标签，为None时全部为'O'"""
+        text = ''.join(words)
+        if len(text) != len(words):
+            raise ValueError("binary corpus expects one character per word")
+        tokens, token_starts = self.char_vocab.encode_aligned(words)
+        label_ids = [self.label2id['O']] * len(words) if labels is None else [self.label2id[t] for t in labels]
+        self._write('tokens', [self.cls_id])
+        self._write('tokens', tokens)
+        self._write('token_starts', 1 + token_starts)
+        self._write('labels', label_ids)
+        self.files['chars'].write(text.encode('utf-32-le'))
+        self.num_sentences += 1
+        self.num_tokens += 1 + len(tokens)
+        self.num_chars += len(words)
+        self._write('token_offsets', [self.num_tokens])
+        self._write('char_offsets', [self.num_chars])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        meta = {'num_sentences': self.num_sentences, 'num_tokens': self.num_tokens, 'num_chars': self.num_chars,
+                'vocab_size': len(self.char_vocab.tokenizer), 'label2id': self.label2id}
+        with open(os.path.join(self.corpus_dir, META_FILE + '.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(os.path.join(self.corpus_dir, META_FILE + '.tmp'), os.path.join(self.corpus_dir, META_FILE))
+        logging.info("--------Write {} sentences to {}--------".format(self.num_sentences, self.corpus_dir))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self.files.values():
+                f.close()
+
+
+def corpus_exists(corpus_dir):
+    return os.path.exists(os.path.join(corpus_dir, META_FILE))
+
+
+class Corpus(object):
+    """CorpusWriter 写出的语料，所有数组都是只读的 np.memmap，按句随机访问不复制整份数据"""
+
+    def __init__(self, corpus_dir, config):
+        with open(os.path.join(corpus_dir, META_FILE), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta['label2id'] != config.label2id:
+            raise ValueError("label2id of corpus {} does not match config".format(corpus_dir))
+        if self.meta['vocab_size'] != len(utils.get_tokenizer(config.bert_model)):
+            raise ValueError("corpus {} was encoded with a different vocab".format(corpus_dir))
+        self.corpus_dir = corpus_dir
+        for name, dtype in ARRAYS.items():
+            setattr(self, name, self._load(name, dtype))
+
+    def _load(self, name, dtype):
+        path = os.path.join(self.corpus_dir, name + '.bin')
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self.meta['num_sentences']
+
+    def lengths(self):
+        """每句的token数（含[CLS]）"""
+        return np.diff(self.token_offsets)
+
+    def sentence(self, idx):
+        """returns: ((token ids, token starts), label ids, 单字列表)，与 NERDataset 的样本格式一致"""
+        token_begin, token_end = self.token_offsets[idx], self.token_offsets[idx + 1]
+        char_begin, char_end = self.char_offsets[idx], self.char_offsets[idx + 1]
+        words = list(self.chars[char_begin:char_end].tobytes().decode('utf-32-le'))
+        return ((self.tokens[token_begin:token_end], self.token_starts[char_begin:char_end]),
+                self.labels[char_begin:char_end], words)
@@ -4,19 +4,22 @@
 
 import torch
 import numpy as np
-from transformers import BertTokenizer
-from torch.utils.data import Dataset
+import utils
+from torch.utils.data import Dataset, DataLoader
+from sampler import BucketBatchSampler
 
 
 class NERDataset(Dataset):
     def __init__(self, words, labels, config, word_pad_idx=0, label_pad_idx=-1):
-        self.tokenizer = BertTokenizer.from_pretrained(config.bert_model, do_lower_case=True)
-        self.label2id = config.label2id
-        self.id2label = {_id: _label for _label, _id in list(config.label2id.items())}
+        self.tokenizer = utils.get_tokenizer(config.bert_model)
+        self.char_vocab = utils.get_char_vocab(config.bert_model)
+        self.label2id, self.id2label = utils.get_label_maps(config.label2id)
         self.dataset = self.preprocess(words, labels)
         self.word_pad_idx = word_pad_idx
         self.label_pad_idx = label_pad_idx
-        self.device = config.device
+        # 是否把多个短句拼接到同一行（block-diagonal attention）
+        self.pack = config.pack_sequences
+        self.max_pack_len = config.max_pack_len
 
     def preprocess(self, origin_sentences, origin_labels):
         """
@@ -31,26 +34,21 @@ class NERDataset(Dataset):
         sentences = []
         labels = []
 
+        cls_id = self.tokenizer.convert_tokens_to_ids('[CLS]')
         for line in origin_sentences:
             # replace each token by its index
             # we can not use encode_plus because our sentences are aligned to labels in list type
-            words = []
-            word_lens = []
-            for token in line:
-                words.append(self.tokenizer.tokenize(token))
-                word_lens.append(len(token))
-            print("words:", words)
-            print("words_len:", len(words))
-
-            # 变成单个字的列表，开头加上[CLS]
-            words = ['[CLS]'] + [item for token in words for item in token]
-            print("words_cls:", words)
-            print("words_cls_len:", len(words))
-            token_start_idxs = 1 + np.cumsum([0] + word_lens[:-1])
-            sentences.append((self.tokenizer.convert_tokens_to_ids(words), token_start_idxs))
+            # 按每个字实际的子词数计算起始位置，tokenize 后为空的字（空格等）编码为[UNK]
+            token_ids, token_start_idxs = self.char_vocab.encode_aligned(line)
+            token_ids = np.concatenate([[cls_id], token_ids]).tolist()
+            token_start_idxs = 1 + token_start_idxs
+            sentences.append((token_ids, token_start_idxs))
 
+        # 预测时不需要label
+        if origin_labels is None:
+            origin_labels = [None] * len(sentences)
         for tag in origin_labels:
-            label_id = [self.label2id.get(t) for t in tag]
+            label_id = None if tag is None else [self.label2id.get(t) for t in tag]
             labels.append(label_id)
 
         for sentence, label, origin_sentence in zip(sentences, labels, origin_sentences):
@@ -68,60 +66,212 @@ class NERDataset(Dataset):
         """get dataset size"""
         return len(self.dataset)
 
+    def lengths(self):
+        """每个样本的token数（含[CLS]），用于按长度分桶"""
+        return [len(sentence[0]) for sentence, _, _ in self.dataset]
+
     def collate_fn(self, batch):
+        """
+        returns: [batch_data, batch_label_starts, batch_labels, batch_original_contents, batch_packing]
+        batch_packing 只在 pack 模式下不为None，见 pack_collate_fn
+        """
+        if self.pack:
+            return self.pack_collate_fn(batch)
+        return self.pad_collate_fn(batch) + [None]
+
+    def pad_collate_fn(self, batch):
         """
         process batch data, including:
             1. padding: 将每个batch的data padding到同一长度（batch中最长的data长度）
-            2. aligning: 找到每个sentence sequence里面有label项，文本与label对齐
-            3. tensor：转化为tensor
-            4. batch 是 batch_size 目前设置为1
+            2. aligning: 找到每个sentence sequence里面有label项的token位置，文本与label对齐
+            3. tensor：转化为 int64 的 cpu tensor，放到哪个设备上由训练/预测循环决定（见 to_device），
+               这样 DataLoader 可以开 num_workers 和 pin_memory
         """
         sentences = [x[0] for x in batch]
         labels = [x[1] for x in batch]
         origin_contents = [x[2] for x in batch]
 
-        # batch length
-        batch_len = len(sentences)
-
-        # compute length of longest sentence in batch
-        max_origin_len = max([len(s) for s in origin_contents]) # 78
-        max_len = max([len(s[0]) for s in sentences])
-        max_label_len = 0
-
-        # padding data 初始化
-        batch_data = self.word_pad_idx * np.ones((batch_len, max_len)) # 79
-        batch_label_starts = []
-
-        # padding and aligning
-        for j in range(batch_len):
-            cur_len = len(sentences[j][0])                 # 79
-            batch_data[j][:cur_len] = sentences[j][0]      # batch_data 101, 1068, 754, 122, 121, 3299, 123
-            # 找到有标签的数据的index（[CLS]不算）
-            label_start_idx = sentences[j][-1]             # len 78
-            label_starts = np.zeros(max_len)               # len 79
-            label_starts[[idx for idx in label_start_idx if idx < max_len]] = 1
-            batch_label_starts.append(label_starts)        # batch_label_starts 0,1,1,1,1,1,1,,1,1,1,1
-            max_label_len = max(int(sum(label_starts)), max_label_len)
-
-        # padding label
-        batch_labels = self.label_pad_idx * np.ones((batch_len, max_label_len)) # 78
-        for j in range(batch_len):
-            cur_tags_len = len(labels[j])                  # 78
-            batch_labels[j][:cur_tags_len] = labels[j]     # 00000000000000
-        
-        # original content
-        batch_original_contents = np.ones((batch_len, max_origin_len),dtype=str)
-        for j in range(batch_len):
-            cur_original_len = len(origin_contents[j])
-            batch_original_contents[j][:cur_original_len] = origin_contents[j]
-
-        # convert data to torch LongTensors
-        batch_data = torch.tensor(batch_data, dtype=torch.long)
-        batch_label_starts = torch.tensor(batch_label_starts, dtype=torch.long)
-        batch_labels = torch.tensor(batch_labels, dtype=torch.long)
-
-        # shift tensors to GPU if available
-        batch_data, batch_label_starts = batch_data.to(self.device), batch_label_starts.to(self.device)
-        batch_labels = batch_labels.to(self.device)
-
-        return [batch_data, batch_label_starts, batch_labels, batch_original_contents]
+        token_lens = np.array([len(s[0]) for s in sentences])
+        label_lens = np.array([len(s[-1]) for s in sentences])
+        batch_data = self._pad([s[0] for s in sentences], token_lens, self.word_pad_idx)
+        # 每个label对应的token位置（[CLS]不算），padding为0（即[CLS]的位置），模型据此直接gather
+        batch_label_starts = self._pad([s[-1] for s in sentences], label_lens, 0)
+        # gather 没有越界检查，越界的位置会读到padding或报错，这里直接拒绝
+        self._check_starts(batch_label_starts, token_lens[:, None], origin_contents)
+        batch_labels = None
+        if labels[0] is not None:
+            batch_labels = torch.from_numpy(self._pad(labels, label_lens, self.label_pad_idx))
+
+        return [torch.from_numpy(batch_data), torch.from_numpy(batch_label_starts), batch_labels,
+                [list(content) for content in origin_contents]]
+
+    @staticmethod
+    def _check_starts(starts, token_lens, origin_contents):
+        """每个label对应的token位置必须落在该句的token之内，否则说明字与token没有对齐"""
+        bad = np.nonzero(np.atleast_1d((np.asarray(starts) >= token_lens).any(axis=-1)))[0]
+        if len(bad) > 0:
+            raise ValueError("token start out of range, words and tokens are misaligned: {}".format(
+                ''.join(origin_contents[bad[0]])))
+
+    @staticmethod
+    def _pad(rows, lens, pad_idx):
+        """在预分配的 int64 矩阵中一次性填入所有行"""
+        padded = np.full((len(rows), max(lens.max(), 1)), pad_idx, dtype=np.int64)
+        if lens.sum() > 0:
+            padded[np.arange(padded.shape[1]) < lens[:, None]] = np.concatenate(rows)
+        return padded
+
+    def pack_collate_fn(self, batch):
+        """
+        把batch中的句子按顺序依次拼接到长度不超过 max_pack_len 的行中，每句仍以[CLS]开头：
+            batch_data: (num_rows, max_len)
+            batch_label_starts: (num_rows, max_row_label_len)，每个label对应的token在行内的位置
+            batch_labels: (num_sentences, max_label_len)，按句子排列，与解包后的判别值对齐
+            batch_original_contents: 按句子排列的原文
+            batch_packing: (position_ids, segment_ids, segment_label_index)
+                position_ids: 每句从0开始的位置编码
+                segment_ids: token属于行内第几句（从1开始），padding为0，用来构造block-diagonal attention mask
+                segment_label_index: (num_sentences, max_label_len)，每个label在展平后的
+                    (num_rows * max_row_label_len) 判别值中的位置，padding为-1
+        """
+        sentences = [x[0] for x in batch]
+        labels = [x[1] for x in batch]
+        origin_contents = [x[2] for x in batch]
+
+        # 贪心地按顺序分行
+        rows = [[]]
+        row_len = 0
+        for j, sentence in enumerate(sentences):
+            cur_len = len(sentence[0])
+            if rows[-1] and row_len + cur_len > self.max_pack_len:
+                rows.append([])
+                row_len = 0
+            rows[-1].append(j)
+            row_len += cur_len
+
+        max_len = max(sum(len(sentences[j][0]) for j in row) for row in rows)
+        max_row_label_len = max(sum(len(sentences[j][-1]) for j in row) for row in rows)
+        max_label_len = max(len(sentence[-1]) for sentence in sentences)
+
+        batch_data = np.full((len(rows), max_len), self.word_pad_idx, dtype=np.int64)
+        position_ids = np.zeros((len(rows), max_len), dtype=np.int64)
+        segment_ids = np.zeros((len(rows), max_len), dtype=np.int64)
+        batch_label_starts = np.zeros((len(rows), max_row_label_len), dtype=np.int64)
+        segment_label_index = np.full((len(sentences), max_label_len), -1, dtype=np.int64)
+        for r, row in enumerate(rows):
+            token_offset = 0
+            label_offset = 0
+            for k, j in enumerate(row):
+                token_ids, token_start_idxs = sentences[j]
+                cur_len, cur_label_len = len(token_ids), len(token_start_idxs)
+                self._check_starts(token_start_idxs, cur_len, [origin_contents[j]])
+                batch_data[r, token_offset:token_offset + cur_len] = token_ids
+                position_ids[r, token_offset:token_offset + cur_len] = np.arange(cur_len)
+                segment_ids[r, token_offset:token_offset + cur_len] = k + 1
+                batch_label_starts[r, label_offset:label_offset + cur_label_len] = token_offset + np.asarray(token_start_idxs)
+                segment_label_index[j, :cur_label_len] = r * max_row_label_len + label_offset + np.arange(cur_label_len)
+                token_offset += cur_len
+                label_offset += cur_label_len
+
+        batch_labels = None
+        if labels[0] is not None:
+            batch_labels = np.full((len(sentences), max_label_len), self.label_pad_idx, dtype=np.int64)
+            for j, label in enumerate(labels):
+                batch_labels[j, :len(label)] = label
+            batch_labels = torch.from_numpy(batch_labels)
+
+        batch_packing = tuple(torch.from_numpy(t) for t in (position_ids, segment_ids, segment_label_index))
+        return [torch.from_numpy(batch_data), torch.from_numpy(batch_label_starts), batch_labels,
+                origin_contents, batch_packing]
+
+
+class MmapNERDataset(NERDataset):
+    """
+    从 corpus.Corpus（memory-mapped 二进制语料）中按下标取样本，不做 preprocess，
+    样本格式与 NERDataset 一致，可以直接用 build_loader 组batch
+    """
+
+    def __init__(self, corpus, indices, config, word_pad_idx=0, label_pad_idx=-1):
+        self.tokenizer = utils.get_tokenizer(config.bert_model)
+        self.label2id, self.id2label = utils.get_label_maps(config.label2id)
+        self.corpus = corpus
+        self.indices = np.asarray(indices)
+        self.word_pad_idx = word_pad_idx
+        self.label_pad_idx = label_pad_idx
+        self.pack = config.pack_sequences
+        self.max_pack_len = config.max_pack_len
+
+    def __getitem__(self, idx):
+        return list(self.corpus.sentence(self.indices[idx]))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def lengths(self):
+        return self.corpus.lengths()[self.indices]
+
+
+def loader_options(config, workers=False):
+    """
+    DataLoader 的加载参数：num_workers > 0 时在子进程中组batch，与模型计算重叠；
+    workers 为False时（在线服务、单次预测）不启动子进程，每次请求新建 DataLoader 时不用付出进程启动的开销
+    """
+    # pin_memory 只在GPU上有意义
+    options = {'pin_memory': config.pin_memory and config.device.type == 'cuda'}
+    if workers and config.num_workers > 0:
+        options['num_workers'] = config.num_workers
+        options['prefetch_factor'] = config.prefetch_factor
+        options['persistent_workers'] = True
+    return options
+
+
+def build_loader(dataset, config, shuffle=False, workers=False):
+    """
+    config.length_bucketing 为True时按长度分桶组batch：训练时桶内和桶间打乱，预测时按长度排序，
+    train.infer / train.evaluate 会把结果恢复成原始顺序；
+    workers 为True时使用 config.num_workers 等多进程加载参数，只用于训练和评估
+    """
+    options = loader_options(config, workers)
+    if config.length_bucketing:
+        batch_sampler = BucketBatchSampler(dataset.lengths(), config.batch_size, shuffle=shuffle,
+                                           bucket_size=config.batch_size * config.bucket_batches)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn, **options)
+    return DataLoader(dataset, batch_size=config.batch_size, shuffle=shuffle, collate_fn=dataset.collate_fn,
+                      **options)
+
+
+def to_device(batch_samples, device):
+    """
+    把 collate_fn 返回的tensor搬到 device 上，原文保持不变；
+    配合 pin_memory 使用 non_blocking，拷贝与计算重叠
+    """
+    def move(item):
+        if torch.is_tensor(item):
+            return item.to(device, non_blocking=True)
+        if isinstance(item, tuple):
+            return tuple(move(t) for t in item)
+        return item
+
+    batch_data, batch_token_starts, batch_labels, batch_original_contents, batch_packing = batch_samples
+    return [move(batch_data), move(batch_token_starts), move(batch_labels), batch_original_contents,
+            move(batch_packing)]
+
+
+if __name__ == '__main__':
+    # 查表编码与逐字调用 tokenizer 的结果对比：python data_loader.py [train.npz]
+    import sys
+    import config
+
+    if len(sys.argv) > 1:
+        words = np.load(sys.argv[1], allow_pickle=True)['words']
+    else:
+        words = [list('关于10月28日到达广州白云国际机场，ＡＢｃ Café\t①²'), list('。'), []]
+    tokenizer = utils.get_tokenizer(config.bert_model)
+    char_vocab = utils.get_char_vocab(config.bert_model)
+    for line in words:
+        expected = tokenizer.convert_tokens_to_ids([item for token in line for item in tokenizer.tokenize(token)])
+        assert char_vocab.encode(line).tolist() == expected, ''.join(line)
+        # 对齐编码：每个字一个起始位置，且都落在编码结果之内
+        ids, starts = char_vocab.encode_aligned(line)
+        assert len(starts) == len(line) and (starts < max(len(ids), 1)).all(), ''.join(line)
+    print("{} sentences, {} distinct chars: same ids".format(len(words), len(char_vocab.table)))
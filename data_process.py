@@ -4,9 +4,108 @@
 
 import os
 import json
+import time
+import pickle
+import hashlib
+import itertools
+import contextlib
+import multiprocessing
 import config
 import logging
 import numpy as np
+from segment import segment, slices
+from corpus import CorpusWriter, corpus_exists
+
+# 流式读取JSON时每次从文件中读入的字符数
+READ_SIZE = 1 << 20
+# 分片缓存的版本号，process_record 的处理逻辑改变时加一，使旧缓存失效
+CACHE_VERSION = 1
+
+
+def iter_records(path):
+    """
+    逐条产出标注记录，不把整个文件读入内存：
+        文件以 '[' 开头时按JSON数组解析（raw_decode 逐个对象解码），否则按JSONL每行一条记录
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        head = f.read(READ_SIZE)
+        if head.lstrip()[:1] != '[':
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buf = head.lstrip()[1:]
+        pos = 0
+        eof = False
+        while True:
+            # 跳过空白和逗号
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                buf, pos = f.read(READ_SIZE), 0
+                eof = buf == ''
+            if pos >= len(buf):
+                raise ValueError("unterminated json array in {}".format(path))
+            if buf[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # 当前对象不完整，读入更多内容后重试
+                more = f.read(READ_SIZE)
+                eof = more == ''
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield record
+            pos = end
+
+
+def iter_chunks(iterable, size):
+    """把迭代器按 size 条一组切分"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_shard(records, cache_dir=None):
+    """
+    处理一个分片的记录，返回 (字列表的列表, BIO标签列表的列表)；
+    cache_dir 不为None时以分片内容和切分参数的hash为key缓存结果，输入不变时再次运行直接读取
+    """
+    cache_path = None
+    if cache_dir is not None:
+        key = json.dumps([CACHE_VERSION, config.max_segment_len, records], ensure_ascii=False, sort_keys=True)
+        cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+
+    processor = Processor(config)
+    word_lis = []
+    label_lis = []
+    for record in records:
+        words, labels = processor.process_record(record)
+        word_lis.extend(words)
+        label_lis.extend(labels)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # 先写临时文件再改名，多个进程同时写同一个分片也不会读到不完整的文件
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((word_lis, label_lis), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    return word_lis, label_lis
 
 
 class Processor:
@@ -22,14 +121,6 @@ class Processor:
         for file_name in self.config.files:
             self.preprocess(file_name)
 
-    def all_list(self,text,step=511):
-        word_lis = list()
-        for i, list_name in enumerate(text):
-            if i % step == 0:
-                word_lis.append(list())
-            word_lis[-1].append(list_name)
-        return word_lis
-
     def creat_BIO(self,text,labels):
         tag_list = ['O' for i in range(len(text))]
         for start_index, end_index, key in labels:
@@ -40,6 +131,43 @@ class Processor:
                 k +=1
         return tag_list
 
+    def process_record(self, record):
+        """单条标注记录 -> 按句末标点切好的 (字列表的列表, BIO标签列表的列表)"""
+        # labels = json_line[i]['labels']
+        label_entities = record.get('labels', None)
+        text = record['text']
+        texts = list(text.strip())
+
+        # 数据清洗
+        text = [text.replace('\xa0', '-').replace('\t', ',').replace('\ue0e7', '-').replace('\u3000', '-').replace('\n', '。').replace(' ', '-') for text in texts]
+
+        if label_entities is not None:
+            tag_list = self.creat_BIO(text, label_entities)
+        else:
+            tag_list = ['O' for i in range(len(text))]
+        # 按句末标点切成短句，不切断实体
+        offsets = segment(text, tags=tag_list)
+        return slices(text, offsets), slices(tag_list, offsets)
+
+    def process_shards(self, records):
+        """
+        每 stream_chunk_size 条记录为一个分片，用 preprocess_workers 个进程并行处理，
+        按输入顺序产出 (分片记录数, 字列表的列表, BIO标签列表的列表)；
+        每次最多提交 2 * preprocess_workers 个分片，流式读取时内存仍然有界
+        """
+        cache_dir = self.data_dir + 'cache/' if self.config.preprocess_cache else None
+        shards = iter_chunks(records, self.config.stream_chunk_size)
+        workers = self.config.preprocess_workers
+        if workers <= 1:
+            for shard in shards:
+                yield (len(shard),) + process_shard(shard, cache_dir)
+            return
+        with multiprocessing.Pool(workers) as pool:
+            for window in iter_chunks(shards, 2 * workers):
+                results = pool.starmap(process_shard, [(shard, cache_dir) for shard in window])
+                for shard, result in zip(window, results):
+                    yield (len(shard),) + result
+
     def preprocess(self, mode):
         """
         params:
@@ -51,38 +179,43 @@ class Processor:
         """
         input_dir = self.data_dir + str(mode) + '.json'
         output_dir = self.data_dir + str(mode) + '.npz'
-        if os.path.exists(output_dir) is True:
+        corpus_dir = self.data_dir + str(mode) + '_corpus/'
+        if self.config.mmap_corpus and corpus_exists(corpus_dir):
             return
+        if not self.config.mmap_corpus and os.path.exists(output_dir) is True:
+            return
+
+        if self.config.stream_json:
+            # 流式读取，处理完的分片直接写入二进制语料
+            if not self.config.mmap_corpus:
+                raise ValueError("stream_json writes a binary corpus, set mmap_corpus = True")
+            if not os.path.exists(input_dir):
+                input_dir = self.data_dir + str(mode) + '.jsonl'
+            json_line = iter_records(input_dir)
+        else:
+            with open(input_dir, 'r', encoding='utf-8') as f:
+                json_line = json.load(f)
 
         word_lis = []
         label_lis = []
-        with open(input_dir, 'r', encoding='utf-8') as f:
-            json_line = json.load(f)
-
-        for i in range(len(json_line)):
-            # labels = json_line[i]['labels']
-            label_entities = json_line[i].get('labels', None)
-            text = json_line[i]['text']
-            texts = list(text.strip())
-
-            # 数据清洗
-            text = [text.replace('\xa0', '-').replace('\t', ',').replace('\ue0e7', '-').replace('\u3000', '-').replace('\n', '。').replace(' ', '-') for text in texts]
-
-            if label_entities is not None:
-                tag_list = self.creat_BIO(text, label_entities)
-            else:
-                tag_list = ['O' for i in range(len(text))]
-            word_lis.extend(self.all_list(text))
-            label_lis.extend(self.all_list(tag_list))
-
-
-        for i in range(len(word_lis)):
-            print("word_list{%s}:" % i, word_lis[i])
-        # print("word_list:", len(word_lis))
-        # print("word_lis:", word_lis[5])
-        # print("word_lis:", word_lis[1])
-        # print("word_lis:", len(word_lis[1682]))
-        # print("word_lis:", len(word_lis))
+        start = time.time()
+        num_records = 0
+        num_sentences = 0
+        # 写成可以 memory-map 的二进制语料
+        with CorpusWriter(corpus_dir, self.config) if self.config.mmap_corpus else contextlib.nullcontext() as writer:
+            for shard_records, words, labels in self.process_shards(json_line):
+                if writer is not None:
+                    for sentence, tags in zip(words, labels):
+                        writer.add(sentence, tags)
+                else:
+                    word_lis.extend(words)
+                    label_lis.extend(labels)
+                num_records += shard_records
+                num_sentences += len(words)
+                logging.info("{}: {} records, {} sentences, {:.1f} records/s".format(
+                    mode, num_records, num_sentences, num_records / max(time.time() - start, 1e-6)))
+        if writer is not None:
+            logging.info("--------{} data process DONE!--------".format(mode))
 
         # return np.asarray(word_lis),np.asarray(label_lis)
 
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/18 下午 04:30
+
+import functools
+
+import numpy as np
+import torch
+
+# 非法转移的分数，用有限值避免 -inf 参与运算产生 nan
+IMPOSSIBLE = -1e4
+
+
+@functools.lru_cache(maxsize=None)
+def bio_constraints(tags):
+    """
+    根据BIO规则构造转移约束：
+        1. 句首不能是 I-x
+        2. I-x 前面只能是 B-x 或 I-x
+    tags: tuple，按id顺序排列的标签，如 ('O', 'B-name', ..., 'I-name', ...)
+    returns: (allowed_start (num_tags,), allowed_transitions (num_tags, num_tags))，bool 数组
+    """
+    num_tags = len(tags)
+    allowed_start = np.ones(num_tags, dtype=bool)
+    allowed = np.ones((num_tags, num_tags), dtype=bool)
+    for j, tag in enumerate(tags):
+        if not tag.startswith('I-'):
+            continue
+        allowed_start[j] = False
+        for i, prev_tag in enumerate(tags):
+            allowed[i, j] = prev_tag in ('B-' + tag[2:], tag)
+    return allowed_start, allowed
+
+
+def tags_of(label2id):
+    """label2id -> 按id排序的标签tuple，作为 bio_constraints 的参数"""
+    return tuple(label for label, _ in sorted(label2id.items(), key=lambda item: item[1]))
+
+
+def viterbi_decode(emissions, mask, start_transitions, end_transitions, transitions, constraints=None):
+    """
+    批量 Viterbi 解码（torch）
+    emissions: (batch_size, seq_len, num_tags)
+    mask: (batch_size, seq_len)，每行为连续的前缀且第一个位置为1
+    constraints: bio_constraints 的返回值，为 None 时不做约束（与 torchcrf.CRF.decode 一致）
+    returns: (batch_size, seq_len) LongTensor，padding位置为 -1
+    """
+    mask = mask.bool()
+    if constraints is not None:
+        allowed_start, allowed = [torch.as_tensor(c, device=emissions.device) for c in constraints]
+        start_transitions = start_transitions.masked_fill(~allowed_start, IMPOSSIBLE)
+        transitions = transitions.masked_fill(~allowed, IMPOSSIBLE)
+    batch_size, seq_len, _ = emissions.shape
+
+    # 前向：score[b, j] 为到当前位置以j结尾的最优分数
+    score = start_transitions + emissions[:, 0]
+    history = []
+    for i in range(1, seq_len):
+        next_score, indices = (score.unsqueeze(2) + transitions + emissions[:, i].unsqueeze(1)).max(dim=1)
+        score = torch.where(mask[:, i].unsqueeze(1), next_score, score)
+        history.append(indices)
+    score = score + end_transitions
+
+    # 回溯：所有样本同时进行，超出各自长度的位置保持不变
+    seq_ends = mask.sum(dim=1) - 1
+    best_tags = emissions.new_full((batch_size, seq_len), -1, dtype=torch.long)
+    cur_tag = score.argmax(dim=1)
+    best_tags.scatter_(1, seq_ends.unsqueeze(1), cur_tag.unsqueeze(1))
+    for i in range(seq_len - 1, 0, -1):
+        active = seq_ends >= i
+        prev_tag = history[i - 1].gather(1, cur_tag.unsqueeze(1)).squeeze(1)
+        cur_tag = torch.where(active, prev_tag, cur_tag)
+        best_tags[:, i - 1] = torch.where(active, cur_tag, best_tags[:, i - 1])
+    return best_tags
+
+
+def viterbi_decode_numpy(emissions, mask, start_transitions, end_transitions, transitions, constraints=None):
+    """viterbi_decode 的 numpy 实现，供 onnxruntime 后端使用，参数和返回值含义相同"""
+    mask = mask.astype(bool)
+    if constraints is not None:
+        allowed_start, allowed = constraints
+        start_transitions = np.where(allowed_start, start_transitions, IMPOSSIBLE)
+        transitions = np.where(allowed, transitions, IMPOSSIBLE)
+    batch_size, seq_len, _ = emissions.shape
+    rows = np.arange(batch_size)
+
+    score = start_transitions + emissions[:, 0]
+    history = []
+    for i in range(1, seq_len):
+        next_score = score[:, :, None] + transitions + emissions[:, i, None, :]
+        indices = next_score.argmax(axis=1)
+        history.append(indices)
+        score = np.where(mask[:, i, None], np.take_along_axis(next_score, indices[:, None, :], axis=1)[:, 0], score)
+    score = score + end_transitions
+
+    seq_ends = mask.sum(axis=1) - 1
+    best_tags = np.full((batch_size, seq_len), -1, dtype=np.int64)
+    cur_tag = score.argmax(axis=1)
+    best_tags[rows, seq_ends] = cur_tag
+    for i in range(seq_len - 1, 0, -1):
+        active = seq_ends >= i
+        cur_tag = np.where(active, history[i - 1][rows, cur_tag], cur_tag)
+        best_tags[:, i - 1] = np.where(active, cur_tag, best_tags[:, i - 1])
+    return best_tags
+
+
+def to_tag_lists(best_tags):
+    """dense解码结果 -> 去掉padding的嵌套列表"""
+    if torch.is_tensor(best_tags):
+        best_tags = best_tags.cpu().numpy()
+    return [[int(idx) for idx in row if idx > -1] for row in best_tags]
@@ -6,22 +6,17 @@ import os
 import config
 import logging
 import numpy as np
+from segment import segment, slices
 
 class GetData:
 
     def __init__(self,infos):
         self.infos = infos
         self.config = config
+        # 每一段在原始 infos 中的 (start, end)，用于返回实体的字符位置
+        self.offsets = []
         # self.data_dir = config.data_dir
 
-    def all_list(self,text,step=511):
-        word_lis = list()
-        for i, list_name in enumerate(text):
-            if i % step == 0:
-                word_lis.append(list())
-            word_lis[-1].append(list_name)
-        return word_lis
-
     def preprocess(self, mode="predict1"):
         """
         params:
@@ -35,12 +30,17 @@ class GetData:
         word_lis = []
         label_lis = []
 
-        texts = list(self.infos.strip())
+        infos = self.infos.strip()
+        shift = len(self.infos) - len(self.infos.lstrip())
+        offsets = [(start, end) for start, end in segment(infos) if infos[start:end].strip() != ""]
+        self.offsets = [(start + shift, end + shift) for start, end in offsets]
+
+        texts = list(infos)
         text = [text.replace('\xa0', '-').replace('\t', ',').replace('\ue0e7', '-').replace('\u3000', '-').replace('\n', '。') for text in
                 texts]
         tag_list = ['O' for i in range(len(text))]
 
-        word_lis.extend(self.all_list(text))
-        label_lis.extend(self.all_list(tag_list))
+        word_lis.extend(slices(text, offsets))
+        label_lis.extend(slices(tag_list, offsets))
 
         return word_lis, label_lis
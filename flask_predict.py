@@ -5,69 +5,183 @@
 import config
 import logging
 
-from model import BertNER
-from data_loader import NERDataset
+import model_registry
+from model import BertMultiHeadNER
+from data_loader import NERDataset, build_loader
 from train import train, evaluate
+from metrics import pre_label, extract_spans
 from flask_data_process import GetData
-from torch.utils.data import DataLoader
+from aho_corasick import get_automaton
+from result_cache import ResultCache, normalize_sentence
 
 class PredictModel(object):
 
     def __init__(self):
 
+        # chunk级结果缓存，config.cache_size 为0时不使用缓存
+        self.cache = ResultCache(config.cache_size, config.cache_ttl) if config.cache_size > 0 else None
+        self.load_models()
+
+    def load_models(self):
+
         # Prepare model
 
+        # 多头模型一次前向同时给出 name/license 和 date/location
+        if config.multi_head:
+            self.model1 = self.model2 = model_registry.get_model(config.multi_head_dir,
+                                                                 BertMultiHeadNER.from_pretrained)
+            return
+
         # name/license
         if config.model_dir is not None:
-            self.model1 = BertNER.from_pretrained(config.model_dir)
-            self.model1.to(config.device)
-            logging.info("--------Load model from {}--------".format(config.model_dir))
+            self.model1 = model_registry.get_serving_model(config.model_dir)
         else:
             logging.info("--------No model to predict !--------")
             return
 
         # date/location
         if config.model_dir1 is not None:
-            self.model2 = BertNER.from_pretrained(config.model_dir1)
-            self.model2.to(config.device)
-            logging.info("--------Load model from {}--------".format(config.model_dir1))
+            self.model2 = model_registry.get_serving_model(config.model_dir1)
         else:
             logging.info("--------No model to predict !--------")
             return
 
+    def reload(self):
+        """重新从 model_registry 取模型（checkpoint更新后会重新加载），模型变化时清空缓存"""
+        models = (getattr(self, 'model1', None), getattr(self, 'model2', None))
+        self.load_models()
+        if (self.model1, self.model2) != models:
+            self.invalidate_cache()
+
+    def invalidate_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+            logging.info("--------Result cache cleared!--------")
+
     def predict(self, content):
-        data = GetData(content)
-        text = data.preprocess()
-        word_pre = text[0]
-        label_pre = text[1]
-        pre_dataset = NERDataset(word_pre, label_pre, config)
+        return self.predict_batch([content])[0]
+
+    def predict_batch(self, contents):
+        """
+        返回值与逐条调用 predict 一致：[(pre_label, pre_label1), ...]
+        开启缓存时按模型输入的chunk查缓存，只有新出现或修改过的chunk才进入模型；
+        缓存的是每个chunk的标签，实体仍按整条记录聚合，跨chunk的实体与不开缓存时相同
+        """
+        # checkpoint 被重新保存后换用新模型，并清空旧模型的缓存结果
+        self.reload()
+        if self.cache is None:
+            return self._predict_batch(contents)
+
+        words = [GetData(content).preprocess()[0] for content in contents]
+        tags = {}
+        missing = {}
+        for chunk in (chunk for chunks in words for chunk in chunks):
+            # key 只用于查缓存，模型输入是 GetData 处理后的原始字符
+            key = normalize_sentence(chunk)
+            if key in tags or key in missing:
+                continue
+            tags[key] = self.cache.get(key)
+            if tags[key] is None:
+                del tags[key]
+                missing[key] = chunk
+        if missing:
+            pre_metrics, pre_metrics1 = self._tag(list(missing.values()))
+            for key, chunk_tags in zip(missing, zip(pre_metrics['pred_tags'], pre_metrics1['pred_tags'])):
+                self.cache.put(key, chunk_tags)
+                tags[key] = chunk_tags
+        results = []
+        for chunks in words:
+            chunk_tags = [tags[normalize_sentence(chunk)] for chunk in chunks]
+            results.append(tuple(pre_label([t[i] for t in chunk_tags], chunks) for i in range(2)))
+        return results
+
+    def _predict_batch(self, contents):
+        """
+        把多条记录的chunk合并到同一个DataLoader中，每个模型每个batch只跑一次前向，
+        再按记录拆分结果
+        """
+        _, groups, pre_metrics, pre_metrics1 = self._run(contents)
+        if pre_metrics is None:
+            return [(pre_label([], []), pre_label([], [])) for _ in contents]
+        return [(self._scatter(pre_metrics, idxs), self._scatter(pre_metrics1, idxs)) for idxs in groups]
+
+    def predict_spans(self, contents):
+        """
+        返回 [(spans, spans1), ...]，两个模型各自识别出的实体 (label, start, end, text)，
+        start/end 为实体在 content 中的位置 [start, end)，text 为原文片段
+        """
+        self.reload()
+        datas, groups, pre_metrics, pre_metrics1 = self._run(contents)
+        if pre_metrics is None:
+            return [([], []) for _ in contents]
+        return [tuple(extract_spans([metrics['pred_tags'][j] for j in idxs], [metrics['sent_data'][j] for j in idxs],
+                                    data.offsets, content) for metrics in (pre_metrics, pre_metrics1))
+                for data, idxs, content in zip(datas, groups, contents)]
+
+    def _run(self, contents):
+        """
+        returns: (每条记录的 GetData, 每条记录的chunk下标, 两个模型的 evaluate 结果)，没有chunk时结果为None
+        """
+        datas = []
+        word_pre = []
+        owners = []
+        for i, content in enumerate(contents):
+            data = GetData(content)
+            words, _ = data.preprocess()
+            datas.append(data)
+            word_pre.extend(words)
+            owners.extend([i] * len(words))
+        groups = [[] for _ in contents]
+        for j, owner in enumerate(owners):
+            groups[owner].append(j)
+        if len(word_pre) == 0:
+            return datas, groups, None, None
+        return (datas, groups) + self._tag(word_pre)
+
+    def _tag(self, word_pre):
+        """word_pre: chunk列表（每个chunk为字列表），returns: 两个模型的 evaluate 结果"""
+        pre_dataset = NERDataset(word_pre, None, config)
         logging.info("--------Dataset Build!--------")
         # build data_loader
-        pre_loader = DataLoader(pre_dataset, batch_size=config.batch_size,
-                                shuffle=False, collate_fn=pre_dataset.collate_fn)
+        pre_loader = build_loader(pre_dataset, config)
         logging.info("--------Get Data-loader!--------")
 
-
         pre_metrics = evaluate(pre_loader, self.model1, mode='pre')
-        pre_metrics1 = evaluate(pre_loader, self.model2, mode='pre')
-        pre_label = pre_metrics['pre_labels']
-        pre_label1 = pre_metrics1['pre_labels']
-        return pre_label, pre_label1
+        if self.model2 is self.model1:
+            pre_metrics1 = pre_metrics
+        else:
+            pre_metrics1 = evaluate(pre_loader, self.model2, mode='pre')
+        return pre_metrics, pre_metrics1
+
+    @staticmethod
+    def _scatter(metrics, idxs):
+        """取出属于同一条记录的chunk，重新聚合成实体"""
+        return pre_label([metrics['pred_tags'][j] for j in idxs],
+                         [metrics['sent_data'][j] for j in idxs])
 
     def align(self, datas, content):
+        """
+        datas: 原文列表，content: 预测出的实体文本列表；
+        返回在原文中出现过的实体文本（按 content 的顺序），都没有出现时返回 ['']
+        """
         ner_align = []
-        for i, data in enumerate(datas):
-            data_temp = data
-            for j in content:
-                if j == '':
-                    continue
-                if j in data_temp:
-                    ner_align.append(j)
-                    data_temp = data_temp.replace(j, '')
+        for spans in self.align_spans(datas, content):
+            found = {pattern for _, _, pattern in spans}
+            # 同一实体文本在 content 中出现多次时只返回一次，与原来逐个替换的做法一致
+            ner_align.extend(j for j in dict.fromkeys(content) if j in found)
             if len(ner_align) == 0:
                 ner_align.append('')
         return ner_align
 
+    def align_spans(self, datas, content):
+        """
+        用 Aho-Corasick 自动机一次扫描每条原文，返回每条原文中不重叠的匹配 [(start, end, 实体文本), ...]，
+        自动机按 content 缓存，同一组模型输出不会重复构造
+        """
+        patterns = tuple(sorted({j for j in content if j != ''}))
+        automaton = get_automaton(patterns)
+        return [[(start, end, patterns[idx]) for start, end, idx in automaton.search(data)] for data in datas]
+
     def time_slice(self, dates):
         times  = {
             'startTravelDate': "",      # 开始日期(yyyyMMdd)
@@ -81,4 +195,28 @@ class PredictModel(object):
             'endTravelHourStr': "",     # 结束时间(文本)
             'travelDurationStr': "",    # 停留时长(文本)
         }
-        return None
\ No newline at end of file
+        return None
+
+if __name__ == '__main__':
+    # 回归检查：开启缓存时的结果必须与不开缓存时一致（含空白字符、实体紧贴句号的文本）
+    contents = ['到达\t广州白云国际机场', '到达　广州', '发热\xa0到达广州',
+                '7月1日到达广州。张三乘坐粤A12345', ' 到达  广州 ', '到达 广州白云国际机场']
+    cached = PredictModel()
+    if cached.cache is None:
+        cached.cache = ResultCache(1000, config.cache_ttl)
+    uncached = PredictModel()
+    uncached.cache = None
+    expected = uncached.predict_batch(contents)
+    assert cached.predict_batch(contents) == expected
+    # 第二次全部命中缓存
+    assert cached.predict_batch(contents) == expected
+    assert [cached.predict(content) for content in contents] == expected
+    # 逐字标签：每个字一个标签，且单独预测与和其它chunk同batch预测的标签相同
+    chunks = [chunk for content in contents for chunk in GetData(content).preprocess()[0]]
+    batched = uncached._tag(chunks)
+    for j, chunk in enumerate(chunks):
+        alone = uncached._tag([chunk])
+        for metrics, metrics_alone in zip(batched, alone):
+            assert len(metrics['pred_tags'][j]) == len(chunk), ''.join(chunk)
+            assert metrics['pred_tags'][j] == metrics_alone['pred_tags'][0], ''.join(chunk)
+    print('cache parity OK:', cached.cache.stats())
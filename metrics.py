@@ -5,6 +5,7 @@
 import os
 import config
 import logging
+import numpy as np
 
 
 def get_entities(seq):
@@ -22,25 +23,79 @@ def get_entities(seq):
         get_entities(seq)
         [('PER', 0, 1), ('LOC', 3, 3)]
     """
+    uniques, inverse = encode_tags(flatten_tags(seq))
+    table = tag_table(uniques)
+    types, starts, ends = chunks_of_ids(inverse, table)
+    type_names = table[-1]
+    return [(type_names[t], s, e) for t, s, e in zip(types.tolist(), starts.tolist(), ends.tolist())]
+
+
+def flatten_tags(seq):
+    """嵌套列表按句拼接，每句后补一个'O'，末尾再补一个'O'"""
     # for nested list
     if any(isinstance(s, list) for s in seq):
         seq = [item for sublist in seq for item in sublist + ['O']]
-    prev_tag = 'O'
-    prev_type = ''
-    begin_offset = 0
-    chunks = []
-    for i, chunk in enumerate(seq + ['O']):
-        tag = chunk[0]
-        type_ = chunk.split('-')[-1]
+    return list(seq) + ['O']
+
+
+def encode_tags(seq):
+    """标签字符串 -> (出现过的标签列表, 每个位置的标签id数组)"""
+    index = {}
+    ids = np.fromiter((index.setdefault(tag, len(index)) for tag in seq), dtype=np.int64, count=len(seq))
+    return list(index), ids
+
+
+def flatten_ids(batch_ids):
+    """
+    (batch_size, seq_len) 的标签id矩阵（padding为-1）-> 一维数组，每行后补一个-1；
+    -1 在 tag_table 中按'O'处理，真实标签与预测结果padding位置相同，拼接后实体集合的比较与 flatten_tags 一致
+    """
+    batch_ids = np.asarray(batch_ids)
+    return np.concatenate([batch_ids, np.full((len(batch_ids), 1), -1, dtype=batch_ids.dtype)], axis=1).ravel()
 
-        if end_of_chunk(prev_tag, tag, prev_type, type_):
-            chunks.append((prev_type, begin_offset, i - 1))
-        if start_of_chunk(prev_tag, tag, prev_type, type_):
-            begin_offset = i
-        prev_tag = tag
-        prev_type = type_
 
-    return chunks
+def tag_table(tags):
+    """
+    按id排列的标签 -> end_of_chunk / start_of_chunk 中用到的每个标签的属性表：
+        (is_S, is_BI, is_BSO, is_BS, is_SO, is_I, is_entity, 类型id, '' 的类型id, 类型名列表)
+    类型 '' 是序列开始之前的类型
+    """
+    first = np.array([tag[0] for tag in tags])
+    type_names = sorted({tag.split('-')[-1] for tag in tags} | {''})
+    type_index = {name: i for i, name in enumerate(type_names)}
+    type_ids = np.array([type_index[tag.split('-')[-1]] for tag in tags], dtype=np.int64)
+    return (first == 'S', np.isin(first, ['B', 'I']), np.isin(first, ['B', 'S', 'O']), np.isin(first, ['B', 'S']),
+            np.isin(first, ['S', 'O']), first == 'I', ~np.isin(first, ['O', '.']), type_ids, type_index[''],
+            type_names)
+
+
+def chunks_of_ids(tag_ids, table):
+    """
+    get_entities 的数组实现，逐位置判断的规则与 end_of_chunk / start_of_chunk 完全相同
+    tag_ids: 一维标签id数组（已经按 flatten_tags 拼接并在末尾补'O'），table: tag_table 的返回值
+    returns: (类型id, 起始位置, 结束位置) 三个数组
+    """
+    is_s, is_bi, is_bso, is_bs, is_so, is_i, is_entity, type_ids, empty_type, _ = table
+    tag_ids = np.asarray(tag_ids)
+    # 第一个位置之前视为 prev_tag='O', prev_type=''
+    prev_ids = tag_ids[:-1]
+    type_ = type_ids[tag_ids]
+    prev_type = np.concatenate([[empty_type], type_ids[prev_ids]])
+    type_changed = prev_type != type_
+
+    def prev(flags, first=False):
+        return np.concatenate([[first], flags[prev_ids]])
+
+    end = prev(is_s) | (prev(is_bi) & is_bso[tag_ids]) | (prev(is_entity) & type_changed)
+    start = is_bs[tag_ids] | (prev(is_so, True) & is_i[tag_ids]) | \
+        (is_entity[tag_ids] & type_changed)
+
+    # 每个结束位置对应的起点：该位置之前最近一次 start（初始为0）
+    positions = np.arange(len(tag_ids))
+    last_start = np.maximum.accumulate(np.where(start, positions, 0))
+    ends = np.nonzero(end)[0]
+    begins = np.concatenate([[0], last_start[:-1]])[ends]
+    return prev_type[ends], begins, ends - 1
 
 
 def end_of_chunk(prev_tag, tag, prev_type, type_):
@@ -132,11 +187,44 @@ def f1_score(y_true, y_pred, mode='dev'):
         f1_score(y_true, y_pred)
         0.50
     """
-    true_entities = set(get_entities(y_true))
-    pred_entities = set(get_entities(y_pred))
-    nb_correct = len(true_entities & pred_entities)
-    nb_pred = len(pred_entities)
-    nb_true = len(true_entities)
+    true_seq = flatten_tags(y_true)
+    pred_seq = flatten_tags(y_pred)
+    # 真实标签和预测共用一张标签表，类型id可以直接比较
+    uniques, inverse = encode_tags(true_seq + pred_seq)
+    table = tag_table(uniques)
+    return entity_f1(chunks_of_ids(inverse[:len(true_seq)], table), chunks_of_ids(inverse[len(true_seq):], table),
+                     table[-1], mode)
+
+
+def f1_score_ids(y_true, y_pred, id2label, mode='dev'):
+    """
+    与 f1_score 结果相同，直接使用标签id
+    y_true, y_pred: flatten_ids 得到的一维数组（padding为-1），两者padding位置相同
+    """
+    # -1 映射到表中最后一个标签'O'
+    tags = [id2label[idx] for idx in range(len(id2label))] + ['O']
+    table = tag_table(tags)
+    return entity_f1(chunks_of_ids(np.asarray(y_true) % len(tags), table),
+                     chunks_of_ids(np.asarray(y_pred) % len(tags), table), table[-1], mode)
+
+
+def entity_f1(true_chunks, pred_chunks, type_names, mode='dev'):
+    """
+    chunks_of_ids 的结果 -> 总体f1；mode 不为'dev'时同时返回 config.labels 中每个label的f1
+    每个实体编码成一个整数，集合运算和按label计数都在numpy中完成
+    """
+    size = max([int(chunks[2].max()) for chunks in (true_chunks, pred_chunks) if len(chunks[2])] + [0]) + 2
+
+    def keys(chunks):
+        types, starts, ends = chunks
+        return np.unique((types * size + starts) * size + ends + 1)
+
+    true_keys = keys(true_chunks)
+    pred_keys = keys(pred_chunks)
+    correct_keys = np.intersect1d(true_keys, pred_keys, assume_unique=True)
+    nb_correct = len(correct_keys)
+    nb_pred = len(pred_keys)
+    nb_true = len(true_keys)
 
     p = nb_correct / nb_pred if nb_pred > 0 else 0
     r = nb_correct / nb_true if nb_true > 0 else 0
@@ -144,19 +232,14 @@ def f1_score(y_true, y_pred, mode='dev'):
     if mode == 'dev':
         return score
     else:
+        # 每个类型的实体数，一次 bincount 得到
+        counts = [np.bincount(k // (size * size), minlength=len(type_names)).tolist()
+                  for k in (correct_keys, pred_keys, true_keys)]
+        type_index = {name: i for i, name in enumerate(type_names)}
         f_score = {}
         for label in config.labels:
-            true_entities_label = set()
-            pred_entities_label = set()
-            for t in true_entities:
-                if t[0] == label:
-                    true_entities_label.add(t)
-            for p in pred_entities:
-                if p[0] == label:
-                    pred_entities_label.add(p)
-            nb_correct_label = len(true_entities_label & pred_entities_label)
-            nb_pred_label = len(pred_entities_label)
-            nb_true_label = len(true_entities_label)
+            t = type_index.get(label)
+            nb_correct_label, nb_pred_label, nb_true_label = [0, 0, 0] if t is None else [c[t] for c in counts]
 
             p_label = nb_correct_label / nb_pred_label if nb_pred_label > 0 else 0
             r_label = nb_correct_label / nb_true_label if nb_true_label > 0 else 0
@@ -180,50 +263,63 @@ def bad_case(y_true, y_pred, data):
 
     logging.info("--------Bad Cases reserved !--------")
 
-def make_join(y_pred,data):
-    sentences = []
-    for idx, p in enumerate(y_pred):
-        sentence = []
-        sentence.append(''.join(data[idx]))
-        sentences.append(sentence)
-    return sentences
+def extract_spans(y_pred, data, offsets=None, content=None):
+    """
+    一次线性扫描解码结果，得到实体 (label, start, end, text)，位置为 [start, end)
+    params:
+        y_pred: 每个chunk的BIO标签
+        data: 每个chunk的字列表
+        offsets: 每个chunk在原文中的 (start, end)（GetData.offsets），为None时按chunk首尾相接计算位置
+        content: 原文，给出时 text 取原文中的片段，否则由 data 中的字拼接
+    规则与 pre_label 一致：B 开始新实体，I 延续当前实体（没有实体时开始新实体），其余标签结束实体，
+    实体的 label 为其中出现次数最多的类型（次数相同取先出现的）；
+    chunk 以 I 开头且与上一个chunk相接时延续上一个chunk末尾的实体
+    examples:
+        extract_spans([['B-name', 'I-name', 'O']], [['周', '静', '说']]) -> [('name', 0, 2, '周静')]
+    """
+    spans = []
+    # 当前实体：[start, end, 各类型出现次数, 字列表]
+    entity = None
+    position = 0
+    for i, (tags, chars) in enumerate(zip(y_pred, data)):
+        base = offsets[i][0] if offsets is not None else position
+        position = base + len(chars)
+        if entity is not None and entity[1] != base:
+            spans.append(_close_span(entity, content))
+            entity = None
+        for j, (char, tag) in enumerate(zip(chars, tags)):
+            if tag[0] == "B" or (tag[0] == "I" and entity is None):
+                if entity is not None:
+                    spans.append(_close_span(entity, content))
+                entity = [base + j, base + j + 1, {tag[2:]: 1}, [char]]
+            elif tag[0] == "I":
+                entity[1] = base + j + 1
+                entity[2][tag[2:]] = entity[2].get(tag[2:], 0) + 1
+                entity[3].append(char)
+            elif entity is not None:
+                spans.append(_close_span(entity, content))
+                entity = None
+    if entity is not None:
+        spans.append(_close_span(entity, content))
+    return spans
+
+
+def _close_span(entity, content):
+    start, end, counts, chars = entity
+    text = content[start:end] if content is not None else ''.join(chars)
+    return max(counts, key=counts.get), start, end, text
 
 
-def pre_label(y_pred,data):
+def pre_label(y_pred, data):
+    """按 config.labels 归类 extract_spans 得到的实体文本"""
     map_dict = dict()
     for label in config.labels:
         map_dict[label] = []
 
-    sentences = make_join(y_pred,data)
-
-    entity_name = ""
-    flag = []
-    for i, _ in enumerate(sentences):
-        for char, tag in zip(sentences[i][0], y_pred[i]):
-            if tag[0] == "B":
-                if entity_name != "":
-                    x = dict((a, flag.count(a)) for a in flag)
-                    y = [k for k, v in x.items() if max(x.values()) == v]
-                    for label in config.labels:
-                        if y[0] in label:
-                            map_dict[label].append(entity_name)
-                    flag.clear()
-                    entity_name = ""
-                entity_name += char
-                flag.append(tag[2:])
-            elif tag[0] == "I":
-                entity_name += char
-                flag.append(tag[2:])
-            else:
-                if entity_name != "":
-                    x = dict((a, flag.count(a)) for a in flag)
-                    y = [k for k, v in x.items() if max(x.values()) == v]
-                    for label in config.labels:
-                        if y[0] in label:
-                            map_dict[label].append(entity_name)
-                    flag.clear()
-                flag.clear()
-                entity_name = ""
+    for entity_type, _, _, text in extract_spans(y_pred, data):
+        for label in config.labels:
+            if entity_type in label:
+                map_dict[label].append(text)
     return map_dict
 
 if __name__ == "__main__":
@@ -3,11 +3,100 @@
 # __time : 2021/11/22 下午 07:15
 
 from transformers.models.bert.modeling_bert import *
-from torch.nn.utils.rnn import pad_sequence
 from torchcrf import CRF
 
+import config
+from decoder import viterbi_decode, bio_constraints, tags_of
 
-class BertNER(BertPreTrainedModel):
+
+def align_to_labels(sequence_output, input_token_starts):
+    """
+    去除[CLS]标签等位置，获得与label对齐的表示
+    input_token_starts: (batch_size, max_label_len)，每个label对应的token位置，padding位置为0
+    returns: (batch_size, max_label_len, hidden_size)，padding位置为0
+    """
+    index = input_token_starts.unsqueeze(-1).expand(-1, -1, sequence_output.size(-1))
+    aligned_output = torch.gather(sequence_output, 1, index)
+    return aligned_output * input_token_starts.gt(0).unsqueeze(-1).to(aligned_output.dtype)
+
+
+def head_label2id(head_labels):
+    """某个头的label子集：O + B-x + I-x，顺序与 config.label2id 的组织方式一致"""
+    tags = ['O'] + ['B-' + label for label in head_labels] + ['I-' + label for label in head_labels]
+    return {tag: i for i, tag in enumerate(tags)}
+
+
+class BertNERBase(BertPreTrainedModel):
+    """
+    BertNER 和 BertMultiHeadNER 共用的编码和推理接口
+    input_data: (input_ids, input_token_starts) 或 (input_ids, input_token_starts, packing)，
+        packing 为 NERDataset.pack_collate_fn 给出的 (position_ids, segment_ids, segment_label_index)
+    """
+
+    @staticmethod
+    def unpack_input(input_data):
+        packing = input_data[2] if len(input_data) > 2 else None
+        return input_data[0], input_data[1], packing
+
+    def encode(self, input_data, token_type_ids=None, attention_mask=None, position_ids=None,
+               inputs_embeds=None, head_mask=None):
+        """encoder + 与label对齐 + dropout，pack模式下每句只看到自己（block-diagonal attention），位置编码各自从0开始"""
+        input_ids, input_token_starts, packing = self.unpack_input(input_data)
+        if packing is not None:
+            position_ids, segment_ids, _ = packing
+            # (batch_size, seq_len, seq_len)，padding之间互相可见，避免整行被mask
+            attention_mask = segment_ids.unsqueeze(2).eq(segment_ids.unsqueeze(1))
+        outputs = self.bert(input_ids,
+                            attention_mask=attention_mask,
+                            token_type_ids=token_type_ids,
+                            position_ids=position_ids,
+                            head_mask=head_mask,
+                            inputs_embeds=inputs_embeds)
+        sequence_output = outputs[0]
+
+        # 去除[CLS]标签等位置，将sequence_output的pred_label维度padding到最大长度
+        padded_sequence_output = align_to_labels(sequence_output, input_token_starts)
+        # dropout pred_label的一部分feature
+        return self.dropout(padded_sequence_output)
+
+    @staticmethod
+    def unpack_segments(logits, packing):
+        """pack模式下把 (num_rows, row_label_len, num_labels) 的判别值拆回每句一行"""
+        if packing is None:
+            return logits
+        segment_label_index = packing[2]
+        segment_logits = logits.reshape(-1, logits.size(-1))[segment_label_index.clamp(min=0)]
+        return segment_logits * segment_label_index.ge(0).unsqueeze(-1).to(segment_logits.dtype)
+
+    def decode(self, input_data, token_type_ids=None, attention_mask=None):
+        """
+        只做推理：一次encoder前向 + CRF解码，不计算loss，也不需要labels
+        returns: (batch_size, max_label_len) LongTensor，padding位置为-1
+        """
+        logits = self(input_data, token_type_ids=token_type_ids, attention_mask=attention_mask)[0]
+        return self.decode_emissions(logits, self.label_mask(input_data))
+
+    def restrict_labels(self, labels):
+        """模型能预测的label之外的标签置为O，用于计算dev/test指标"""
+        return labels
+
+    @staticmethod
+    def crf_decode(crf, logits, mask, tags):
+        """用 crf 的参数做批量Viterbi解码，config.bio_constraint 为True时禁止非法的BIO转移"""
+        constraints = bio_constraints(tags) if config.bio_constraint else None
+        return viterbi_decode(logits, mask, crf.start_transitions, crf.end_transitions, crf.transitions,
+                              constraints)
+
+    @classmethod
+    def label_mask(cls, input_data):
+        """与（解包后的）logits对齐的label mask"""
+        _, input_token_starts, packing = cls.unpack_input(input_data)
+        if packing is not None:
+            return packing[2].ge(0)
+        return input_token_starts.gt(0)
+
+
+class BertNER(BertNERBase):
     def __init__(self, config):
         super(BertNER, self).__init__(config)
         self.num_labels = config.num_labels
@@ -21,24 +110,11 @@ class BertNER(BertPreTrainedModel):
 
     def forward(self, input_data, token_type_ids=None, attention_mask=None, labels=None,
                 position_ids=None, inputs_embeds=None, head_mask=None):
-        input_ids, input_token_starts = input_data
-        outputs = self.bert(input_ids,
-                            attention_mask=attention_mask,
-                            token_type_ids=token_type_ids,
-                            position_ids=position_ids,
-                            head_mask=head_mask,
-                            inputs_embeds=inputs_embeds)
-        sequence_output = outputs[0]
-
-        # 去除[CLS]标签等位置，获得与label对齐的pre_label表示
-        origin_sequence_output = [layer[starts.nonzero().squeeze(1)]
-                                  for layer, starts in zip(sequence_output, input_token_starts)]
-        # 将sequence_output的pred_label维度padding到最大长度
-        padded_sequence_output = pad_sequence(origin_sequence_output, batch_first=True)
-        # dropout pred_label的一部分feature
-        padded_sequence_output = self.dropout(padded_sequence_output)
-        # 得到判别值
-        logits = self.classifier(padded_sequence_output)
+        padded_sequence_output = self.encode(input_data, token_type_ids, attention_mask, position_ids,
+                                             inputs_embeds, head_mask)
+        packing = self.unpack_input(input_data)[2]
+        # 得到判别值，pack模式下拆回每句一行
+        logits = self.unpack_segments(self.classifier(padded_sequence_output), packing)
         outputs = (logits,)
         if labels is not None:
             loss_mask = labels.gt(-1)
@@ -48,3 +124,96 @@ class BertNER(BertPreTrainedModel):
         # contain: (loss), scores
         return outputs
 
+    def decode_emissions(self, logits, mask):
+        return self.crf_decode(self.crf, logits, mask, tags_of(config.label2id))
+
+
+class BertMultiHeadNER(BertNERBase):
+    """
+    一个BERT编码器 + 多个 classifier/CRF 头，每个头只负责 config.heads 中的一个label子集
+    config 需要额外带上:
+        heads: [['name', 'license'], ['date', 'location']]
+        ner_label2id: 全局的 label2id，输入输出的label id都使用全局id
+    """
+
+    def __init__(self, config):
+        super(BertMultiHeadNER, self).__init__(config)
+        self.heads = config.heads
+
+        self.bert = BertModel(config)
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.classifiers = nn.ModuleList()
+        self.crfs = nn.ModuleList()
+        for k, head in enumerate(self.heads):
+            local_label2id = head_label2id(head)
+            self.classifiers.append(nn.Linear(config.hidden_size, len(local_label2id)))
+            self.crfs.append(CRF(len(local_label2id), batch_first=True))
+            # 全局id -> 头内id（不属于该头的label映射为O），以及反向映射
+            to_local = torch.zeros(len(config.ner_label2id), dtype=torch.long)
+            to_global = torch.zeros(len(local_label2id), dtype=torch.long)
+            for tag, local_id in local_label2id.items():
+                to_local[config.ner_label2id[tag]] = local_id
+                to_global[local_id] = config.ner_label2id[tag]
+            self.register_buffer('to_local_{}'.format(k), to_local, persistent=False)
+            self.register_buffer('to_global_{}'.format(k), to_global, persistent=False)
+
+        self.init_weights()
+
+    def forward(self, input_data, token_type_ids=None, attention_mask=None, labels=None,
+                position_ids=None, inputs_embeds=None, head_mask=None):
+        padded_sequence_output = self.encode(input_data, token_type_ids, attention_mask, position_ids,
+                                             inputs_embeds, head_mask)
+        packing = self.unpack_input(input_data)[2]
+        # 每个头各自的判别值
+        logits = [self.unpack_segments(classifier(padded_sequence_output), packing)
+                  for classifier in self.classifiers]
+        outputs = (logits,)
+        if labels is not None:
+            loss_mask = labels.gt(-1)
+            loss = 0
+            for k, crf in enumerate(self.crfs):
+                local_labels = getattr(self, 'to_local_{}'.format(k))[labels.clamp(min=0)]
+                loss = loss + crf(logits[k], local_labels, loss_mask) * (-1)
+            outputs = (loss,) + outputs
+
+        # contain: (loss), [scores of each head]
+        return outputs
+
+    def decode_emissions(self, logits, mask):
+        """各头分别解码后转换回全局id；同一位置多个头都有实体时取靠前的头"""
+        merged = None
+        for k, (crf, head) in enumerate(zip(self.crfs, self.heads)):
+            paths = self.crf_decode(crf, logits[k], mask, tags_of(head_label2id(head)))
+            to_global = getattr(self, 'to_global_{}'.format(k))
+            paths = torch.where(paths.gt(-1), to_global[paths.clamp(min=0)], paths)
+            merged = paths if merged is None else torch.where(merged.eq(0), paths, merged)
+        return merged
+
+    def restrict_labels(self, labels):
+        covered = torch.zeros_like(self.to_local_0, dtype=torch.bool)
+        for k in range(len(self.heads)):
+            covered |= getattr(self, 'to_local_{}'.format(k)).gt(0)
+        return torch.where(labels.gt(-1) & ~covered[labels.clamp(min=0)], torch.zeros_like(labels), labels)
+
+    @classmethod
+    def from_single_heads(cls, model_dirs, heads, label2id):
+        """
+        把若干个已训练好的 BertNER checkpoint 合并成一个多头模型：
+        编码器取自第一个checkpoint，第k个头的 classifier/CRF 取自第k个checkpoint中对应label的行。
+        其余头原本是在另一个编码器上训练的，合并后需要再微调（可以只训练头部）。
+        """
+        sources = [BertNER.from_pretrained(model_dir) for model_dir in model_dirs]
+        bert_config = sources[0].config
+        bert_config.heads = heads
+        bert_config.ner_label2id = label2id
+        model = cls(bert_config)
+        model.bert.load_state_dict(sources[0].bert.state_dict())
+        with torch.no_grad():
+            for k, (source, head) in enumerate(zip(sources, heads)):
+                ids = [label2id[tag] for tag in head_label2id(head)]
+                model.classifiers[k].weight.copy_(source.classifier.weight[ids])
+                model.classifiers[k].bias.copy_(source.classifier.bias[ids])
+                model.crfs[k].start_transitions.copy_(source.crf.start_transitions[ids])
+                model.crfs[k].end_transitions.copy_(source.crf.end_transitions[ids])
+                model.crfs[k].transitions.copy_(source.crf.transitions[ids][:, ids])
+        return model
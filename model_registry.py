@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/18 上午 11:05
+
+import os
+import time
+import logging
+import threading
+
+import torch
+
+import config
+from model import BertNER
+
+_models = {}
+_lock = threading.Lock()
+
+
+class ModelEntry(object):
+    def __init__(self, model_dir, mtime, model, load_time):
+        self.model_dir = model_dir
+        self.mtime = mtime
+        self.model = model
+        self.load_time = load_time
+        self.memory = model_memory(model)
+
+    @property
+    def key(self):
+        return self.model_dir, self.mtime
+
+    def stats(self):
+        return {'model_dir': self.model_dir, 'mtime': self.mtime,
+                'load_time': self.load_time, 'memory_mb': self.memory / 1024 ** 2}
+
+
+def checkpoint_mtime(model_dir):
+    """checkpoint目录下最新文件的修改时间（不含子目录），权重被覆盖后会变化"""
+    paths = [os.path.join(model_dir, name) for name in os.listdir(model_dir)]
+    mtimes = [os.path.getmtime(path) for path in paths if os.path.isfile(path)]
+    return max(mtimes) if mtimes else os.path.getmtime(model_dir)
+
+
+def model_memory(model):
+    """权重占用的字节数，按state_dict统计，量化后的packed参数也计算在内"""
+    if not isinstance(model, torch.nn.Module):
+        return model.memory()
+    memory = 0
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, (tuple, list)) else [value]
+        memory += sum(t.numel() * t.element_size() for t in tensors if torch.is_tensor(t))
+    return memory
+
+
+def get_entry(model_dir, loader=BertNER.from_pretrained):
+    """
+    每个进程中每个checkpoint只加载一次，以 (路径, mtime) 作为key；
+    checkpoint被重新保存后会自动加载新权重
+    """
+    mtime = checkpoint_mtime(model_dir)
+    with _lock:
+        entry = _models.get(model_dir)
+        if entry is None or entry.mtime != mtime:
+            start = time.time()
+            model = loader(model_dir)
+            model.to(config.device)
+            model.eval()
+            entry = ModelEntry(model_dir, mtime, model, time.time() - start)
+            _models[model_dir] = entry
+            logging.info("--------Load model from {} in {:.2f}s, {:.1f}MB--------".format(
+                model_dir, entry.load_time, entry.memory / 1024 ** 2))
+    return entry
+
+
+def get_model(model_dir, loader=BertNER.from_pretrained):
+    return get_entry(model_dir, loader).model
+
+
+def get_serving_model(model_dir):
+    """按 config.backend 取得 model_dir 对应的推理模型"""
+    if config.backend == 'onnx':
+        from onnx_backend import OnnxNER
+        return get_model(os.path.join(model_dir, config.onnx_dir_name), OnnxNER.from_pretrained)
+    if config.quantized:
+        from quantize import load_quantized
+        return get_model(os.path.join(model_dir, config.quantized_dir_name), load_quantized)
+    return get_model(model_dir)
+
+
+def model_stats():
+    """已加载模型的加载耗时和内存占用"""
+    with _lock:
+        return [entry.stats() for entry in _models.values()]
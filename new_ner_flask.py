@@ -3,19 +3,30 @@
 # __time : 2021/12/9 下午 06:17
 
 import json
-from flask import Flask, request, Response, Blueprint
+import time
+import logging
+from collections import deque
+from concurrent.futures import TimeoutError
+from flask import Flask, request, Response, Blueprint, stream_with_context
 from flask_cors import CORS
 
+import config
 from flask_predict import PredictModel
+from batcher import DynamicBatcher, QueueFull, DeadlineExceeded
+import model_registry
 
 app = Flask(__name__)
 
+# stream_ner_rows 中一直无法入队的记录
+QUEUE_FULL = object()
+
 class NerApp():
 
     app_blueprint = Blueprint('NerApp', __name__)
 
     def __init__(self):
         NerApp.predict_model = PredictModel()
+        NerApp.batcher = DynamicBatcher(NerApp.predict_model)
 
     def get_flask_app(self, **kwargs):
         app = Flask("PneumoniaRecApp")
@@ -31,100 +42,161 @@ class NerApp():
     def home_page():
         return 'Welcome to use ner'
 
+    @app_blueprint.route('/nerstats')
+    def stats_page():
+        stats = {'models': model_registry.model_stats()}
+        if NerApp.predict_model.cache is not None:
+            stats['cache'] = NerApp.predict_model.cache.stats()
+        stats['batcher'] = NerApp.batcher.stats()
+        return Response(json.dumps({'code': 1, 'msg': "执行成功", 'data': stats}), mimetype='application/json')
+
     @app_blueprint.route('/NER', methods=['post'])
     def ner_demo():
 
         # postman Body json用法
         json_data = request.get_json()
 
-        # 更新
-        keys_names = []
-        for record in json_data:
-            # 更新
-            keys_name = []
-            for keys in record:
-                keys_name.append(keys)
-            keys_names.append(keys_name)
+        try:
+            records = [parse_record(record) for record in json_data]
+        except (ValueError, AttributeError, TypeError):
+            return error_response("请求格式错误", 400)
 
-        # 一行解决
-        # keys_names= [[keys for keys in record]for record in json_data]
+        # 整个请求的 travelContent 一起交给批处理器，空文本不进入模型
+        contents = [record['travelContent'] for record in records if record['travelContent'] != ""]
+        try:
+            predicts = iter(NerApp.batcher.predict_many(contents))
+        except QueueFull:
+            return error_response("服务繁忙，请稍后重试", 429)
+        except DeadlineExceeded:
+            return error_response("请求超时", 503)
 
         ners = []
-        for i, record in enumerate(json_data):
-
-            ner = dict()
-
-            # 更新
-            if "eventId" not in keys_names[i]:
-                get_eventId = ""
-            else:
-                get_eventId = record["eventId"]
-
-            if "caseId" not in keys_names[i]:
-                get_caseId = ""
-            else:
-                get_caseId = record["caseId"]
-
-            if "travelContent" not in keys_names[i]:
-                get_travelContent = ""
-            else:
-                get_travelContent = record["travelContent"]
-
-            if "sourceId" not in keys_names[i]:
-                get_sourceId = ""
-            else:
-                get_sourceId = record["sourceId"]
-
-            # get_eventId = record["eventId"]
-            # get_caseId = record["caseId"]
-            # get_sourceId = record["sourceId"]
-            # get_travelContent = record["travelContent"]
-
-            # 初始化类
-            if get_travelContent == "":
-                n = 0
-            else:
-                predict_ = NerApp.predict_model.predict(get_travelContent)
-
-
-                dates = predict_[1]['date']
-                names = predict_[0]['name']
-                locations = predict_[1]['location']
-                licenses = predict_[0]['license']
-
-                n = max(len(dates), len(names), len(locations), len(licenses))
-
-                # 填充到一样的长度
-                dates.extend([""] * (n - len(dates)))
-                names.extend([""] * (n - len(names)))
-                locations.extend([""] * (n - len(locations)))
-                licenses.extend([""] * (n - len(licenses)))
-
-
-            if n==0:
-                n=1
-                for i in range(n):
-                    ner = {
-                        'eventId': get_eventId,
-                        'caseId': get_caseId,
-                        'sourceId': get_sourceId,
-                        'travelTime': "",  # travelTime
-                        'digPersonName': "",  # digPersonName # 界定标准
-                        'digPlaceName': "",  # digPlaceName
-                        'digTrafficTool': ""  # digTrafficTool
-                    }
-                    ners.append(ner)
-            else:
-                for i in range(n):
-                    ner = {
-                        'eventId': get_eventId,
-                        'caseId': get_caseId,
-                        'sourceId': get_sourceId,
-                        'travelTime': dates[i],  # travelTime
-                        'digPersonName': names[i],  # digPersonName # 界定标准
-                        'digPlaceName': locations[i],  # digPlaceName
-                        'digTrafficTool': licenses[i]  # digTrafficTool
-                    }
-                    ners.append(ner)
+        for record in records:
+            predict_ = next(predicts) if record['travelContent'] != "" else None
+            ners.extend(build_ner_rows(record, predict_))
 
         return Response(json.dumps({'code': 1, 'msg': "执行成功", 'data': ners}), mimetype='application/json')
+
+
+    @app_blueprint.route('/NER/stream', methods=['post'])
+    def ner_stream():
+        """
+        NDJSON 流式接口：请求体每行一条记录，边读边交给批处理器，
+        每条记录的结果行（字段与 /NER 相同）按输入顺序一行一个json写回
+        """
+        return Response(stream_with_context(stream_ner_rows(request.stream, NerApp.batcher)),
+                        mimetype='application/x-ndjson')
+
+
+def error_response(msg, status):
+    return Response(json.dumps({'code': 0, 'msg': msg, 'data': []}), status=status, mimetype='application/json')
+
+
+def parse_record(record):
+    """取出接口需要的字段，缺失的字段置为空字符串；travelContent 不是字符串时抛出 ValueError"""
+    record = {key: record.get(key, "") for key in ('eventId', 'caseId', 'sourceId', 'travelContent')}
+    if not isinstance(record['travelContent'], str):
+        raise ValueError("travelContent must be a string")
+    return record
+
+
+def build_ner_rows(record, predict_):
+    """把一条记录的预测结果展开成接口返回的行，predict_ 为 None 时返回一行空结果"""
+    if predict_ is None:
+        dates, names, locations, licenses = [], [], [], []
+    else:
+        dates = predict_[1]['date']
+        names = predict_[0]['name']
+        locations = predict_[1]['location']
+        licenses = predict_[0]['license']
+
+    n = max(len(dates), len(names), len(locations), len(licenses), 1)
+
+    # 填充到一样的长度
+    dates = dates + [""] * (n - len(dates))
+    names = names + [""] * (n - len(names))
+    locations = locations + [""] * (n - len(locations))
+    licenses = licenses + [""] * (n - len(licenses))
+
+    ners = []
+    for i in range(n):
+        ner = {
+            'eventId': record['eventId'],
+            'caseId': record['caseId'],
+            'sourceId': record['sourceId'],
+            'travelTime': dates[i],  # travelTime
+            'digPersonName': names[i],  # digPersonName # 界定标准
+            'digPlaceName': locations[i],  # digPlaceName
+            'digTrafficTool': licenses[i]  # digTrafficTool
+        }
+        ners.append(ner)
+    return ners
+
+
+def stream_ner_rows(lines, batcher, window=None):
+    """
+    逐行读取记录并逐条产出结果行；同时在途的记录不超过 window（config.stream_window）条，
+    队列满时先等待最早的记录完成，内存占用与请求大小无关
+    """
+    window = window or config.stream_window
+    pending = deque()
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = parse_record(json.loads(line))
+        except (ValueError, AttributeError, TypeError):
+            # 无法解析或 travelContent 不是字符串的行在对应位置返回一行错误
+            pending.append((line_no, None, None, None))
+        else:
+            future = None
+            give_up = time.monotonic() + batcher.timeout
+            while record['travelContent'] != "":
+                try:
+                    future = batcher.submit([record['travelContent']])
+                    break
+                except QueueFull:
+                    if pending:
+                        yield from finish_record(*pending.popleft())
+                    elif time.monotonic() >= give_up:
+                        # 超过 request_timeout 仍无法入队，该记录返回繁忙（对应 /NER 的429），继续处理后面的记录
+                        future = QUEUE_FULL
+                        break
+                    else:
+                        time.sleep(max(batcher.wait_ms, 1) / 1000.0)
+            pending.append((line_no, record, time.monotonic() + batcher.timeout, future))
+        while len(pending) >= window:
+            yield from finish_record(*pending.popleft())
+    while pending:
+        yield from finish_record(*pending.popleft())
+
+
+def finish_record(line_no, record, deadline, future):
+    """
+    等待一条记录的结果，产出它的 NDJSON 行，record 为 None 表示该行无法解析，
+    future 为 QUEUE_FULL 表示队列一直满、记录没有进入模型
+    """
+    if record is None:
+        yield json.dumps({'code': 0, 'msg': "请求格式错误", 'line': line_no}) + '\n'
+        return
+    if future is QUEUE_FULL:
+        yield json.dumps({'code': 0, 'msg': "服务繁忙，请稍后重试", 'eventId': record['eventId'],
+                          'caseId': record['caseId'], 'sourceId': record['sourceId']}) + '\n'
+        return
+    predict_ = None
+    if future is not None:
+        try:
+            predict_ = future.result(max(deadline - time.monotonic(), 0))[0]
+        except (TimeoutError, DeadlineExceeded):
+            future.cancel()
+            yield json.dumps({'code': 0, 'msg': "请求超时", 'eventId': record['eventId'],
+                              'caseId': record['caseId'], 'sourceId': record['sourceId']}) + '\n'
+            return
+        except Exception:
+            # 预测出错时该记录返回一行错误，流继续，不会在响应中途中断
+            logging.exception("--------Stream record {} failed!--------".format(line_no))
+            yield json.dumps({'code': 0, 'msg': "预测失败", 'eventId': record['eventId'],
+                              'caseId': record['caseId'], 'sourceId': record['sourceId']}) + '\n'
+            return
+    for ner in build_ner_rows(record, predict_):
+        yield json.dumps(ner) + '\n'
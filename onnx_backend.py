@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/18 下午 02:20
+
+import os
+import argparse
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import config
+from model import BertNER
+from decoder import viterbi_decode_numpy, bio_constraints, tags_of
+
+ONNX_FILE = 'model.onnx'
+CRF_FILE = 'crf.npz'
+
+
+class EmissionModule(nn.Module):
+    """导出用：encoder + 对齐 + classifier，只输出发射分数，CRF解码留在numpy中做"""
+
+    def __init__(self, model):
+        super(EmissionModule, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_starts):
+        return self.model((input_ids, token_starts), attention_mask=attention_mask)[0]
+
+
+def export_onnx(model_dir, onnx_dir=None, opset_version=14):
+    """
+    把 train.train 保存的 BertNER checkpoint 导出为 onnx，batch 和序列长度均为动态维度。
+    onnx_dir 下保存 model.onnx 以及 CRF 参数 crf.npz
+    """
+    onnx_dir = onnx_dir or os.path.join(model_dir, config.onnx_dir_name)
+    os.makedirs(onnx_dir, exist_ok=True)
+    model = BertNER.from_pretrained(model_dir)
+    model.eval()
+
+    input_ids = torch.tensor([[101, 1068, 754, 122], [101, 3299, 0, 0]], dtype=torch.long)
+    token_starts = torch.tensor([[1, 2, 3], [1, 0, 0]], dtype=torch.long)
+    torch.onnx.export(EmissionModule(model), (input_ids, input_ids.gt(0).long(), token_starts),
+                      os.path.join(onnx_dir, ONNX_FILE),
+                      input_names=['input_ids', 'attention_mask', 'token_starts'],
+                      output_names=['emissions'],
+                      dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                    'attention_mask': {0: 'batch', 1: 'sequence'},
+                                    'token_starts': {0: 'batch', 1: 'label_sequence'},
+                                    'emissions': {0: 'batch', 1: 'label_sequence'}},
+                      opset_version=opset_version)
+    np.savez(os.path.join(onnx_dir, CRF_FILE),
+             start_transitions=model.crf.start_transitions.detach().numpy(),
+             end_transitions=model.crf.end_transitions.detach().numpy(),
+             transitions=model.crf.transitions.detach().numpy())
+    logging.info("--------Export onnx model to {}--------".format(onnx_dir))
+    return onnx_dir
+
+
+class OnnxNER(object):
+    """
+    与 BertNER 推理接口一致的 onnxruntime 后端，可以直接交给 train.infer 使用，
+    CRF解码在numpy中完成
+    """
+
+    def __init__(self, onnx_dir, num_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.onnx_dir = onnx_dir
+        self.session = ort.InferenceSession(os.path.join(onnx_dir, ONNX_FILE), options,
+                                            providers=['CPUExecutionProvider'])
+        crf = np.load(os.path.join(onnx_dir, CRF_FILE))
+        self.start_transitions = crf['start_transitions']
+        self.end_transitions = crf['end_transitions']
+        self.transitions = crf['transitions']
+
+    @classmethod
+    def from_pretrained(cls, onnx_dir):
+        return cls(onnx_dir)
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    def memory(self):
+        """导出目录中全部文件的大小：model.onnx、外部权重文件（如 model.onnx.data）和 crf.npz"""
+        paths = (os.path.join(self.onnx_dir, name) for name in os.listdir(self.onnx_dir))
+        return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+    def emissions(self, input_data, attention_mask=None):
+        if len(input_data) > 2 and input_data[2] is not None:
+            raise ValueError("onnx backend does not support packed sequences")
+        input_ids, token_starts = [t.cpu().numpy() if torch.is_tensor(t) else t for t in input_data[:2]]
+        if attention_mask is None:
+            attention_mask = input_ids > 0
+        elif torch.is_tensor(attention_mask):
+            attention_mask = attention_mask.cpu().numpy()
+        return self.session.run(['emissions'], {'input_ids': input_ids.astype(np.int64),
+                                                'attention_mask': attention_mask.astype(np.int64),
+                                                'token_starts': token_starts.astype(np.int64)})[0]
+
+    def decode(self, input_data, token_type_ids=None, attention_mask=None):
+        emissions = self.emissions(input_data, attention_mask)
+        token_starts = input_data[1]
+        mask = token_starts.cpu().numpy() > 0 if torch.is_tensor(token_starts) else token_starts > 0
+        constraints = bio_constraints(tags_of(config.label2id)) if config.bio_constraint else None
+        return viterbi_decode_numpy(emissions, mask, self.start_transitions, self.end_transitions,
+                                    self.transitions, constraints)
+
+
+def check_parity(model_dir, contents, onnx_dir=None, atol=1e-4):
+    """在同一批输入上对比 torch 与 onnxruntime 的发射分数和解码结果"""
+    from data_loader import NERDataset, build_loader
+
+    onnx_dir = onnx_dir or os.path.join(model_dir, config.onnx_dir_name)
+    torch_model = BertNER.from_pretrained(model_dir)
+    torch_model.eval()
+    onnx_model = OnnxNER(onnx_dir)
+
+    dataset = NERDataset([list(content) for content in contents], None, config)
+    loader = build_loader(dataset, config)
+    max_diff = 0.0
+    same_paths = True
+    with torch.inference_mode():
+        for batch_data, batch_token_starts, _, _, _ in loader:
+            batch_data, batch_token_starts = batch_data.cpu(), batch_token_starts.cpu()
+            batch_masks = batch_data.gt(0)
+            torch_emissions = torch_model((batch_data, batch_token_starts), attention_mask=batch_masks)[0]
+            onnx_emissions = onnx_model.emissions((batch_data, batch_token_starts), batch_masks)
+            max_diff = max(max_diff, float(np.abs(torch_emissions.numpy() - onnx_emissions).max()))
+            torch_paths = torch_model.decode_emissions(torch_emissions,
+                                                       torch_model.label_mask((batch_data, batch_token_starts)))
+            onnx_paths = onnx_model.decode((batch_data, batch_token_starts), attention_mask=batch_masks)
+            same_paths = same_paths and np.array_equal(torch_paths.numpy(), onnx_paths)
+    logging.info("--------onnx parity: max emission diff {}, same paths {}--------".format(max_diff, same_paths))
+    return max_diff <= atol and same_paths
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['export', 'parity'])
+    parser.add_argument('--model_dir', default=config.model_dir)
+    parser.add_argument('--onnx_dir', default=None)
+    parser.add_argument('--text', default='10月28日上午9：40到达广州白云国际机场。')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_onnx(args.model_dir, args.onnx_dir)
+    else:
+        assert check_parity(args.model_dir, [args.text, args.text[:5]], args.onnx_dir)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/20 上午 10:05
+
+import os
+import time
+import signal
+import socket
+import logging
+
+import torch
+import torch.nn as nn
+from flask import Flask
+from werkzeug.serving import make_server
+
+import config
+
+# worker 启动后不到这么多秒就退出时，等待一会再重启，避免反复崩溃时占满CPU
+MIN_WORKER_LIFETIME = 1.0
+
+
+def share_models(models):
+    """
+    把模型参数和buffer移到共享内存，fork出的worker直接映射同一份权重；
+    onnx 等非 nn.Module 后端没有 torch 参数，跳过
+    """
+    shared = set()
+    for model in models:
+        if not isinstance(model, nn.Module) or id(model) in shared:
+            continue
+        try:
+            model.share_memory()
+        except RuntimeError:
+            # 动态量化后的 packed 参数不支持移到共享内存，仍然依赖 fork 的写时复制
+            logging.warning("--------Model {} stays copy-on-write only--------".format(type(model).__name__))
+        shared.add(id(model))
+
+
+def worker_cpus(slot, threads):
+    """第 slot 个 worker 绑定的CPU：按顺序每个 worker 分 threads 个，CPU不够时循环使用"""
+    cpus = sorted(os.sched_getaffinity(0))
+    return {cpus[(slot * threads + i) % len(cpus)] for i in range(threads)}
+
+
+class PreforkServer(object):
+    """
+    父进程加载一次 PredictModel，监听端口后 fork 出 workers 个子进程，共享模型权重和监听socket；
+    每个子进程运行一个多线程的 werkzeug 服务，请求在子进程内由 DynamicBatcher 合并成batch。
+    子进程退出后父进程自动重启，父进程收到 SIGTERM / SIGINT 时结束全部子进程。
+    注意：父进程在 fork 之前不能做推理，否则 torch 的线程池在子进程中可能死锁
+    """
+
+    def __init__(self, host=None, port=None, workers=None, threads=None, cpu_affinity=None):
+        self.host = host or config.serve_host
+        self.port = port or config.serve_port
+        self.workers = workers or config.serve_workers
+        self.threads = threads or config.worker_threads
+        self.cpu_affinity = config.cpu_affinity if cpu_affinity is None else cpu_affinity
+        self.children = {}
+        self.stopping = False
+
+    def build_app(self):
+        from new_ner_flask import NerApp
+
+        ner_app = NerApp()
+        share_models([NerApp.predict_model.model1, NerApp.predict_model.model2])
+        app = Flask(__name__)
+        app.register_blueprint(ner_app.get_flask_blueprint())
+        return app
+
+    def serve(self):
+        app = self.build_app()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(128)
+        sock.set_inheritable(True)
+        logging.info("--------Prefork server listening on {}:{}, {} workers--------".format(
+            self.host, self.port, self.workers))
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for slot in range(self.workers):
+            self._spawn(slot, app, sock)
+
+        while not self.stopping:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            slot, started = self.children.pop(pid, (None, None))
+            if slot is None or self.stopping:
+                continue
+            logging.warning("--------Worker {} (pid {}) exited with status {}, restarting--------".format(
+                slot, pid, status))
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self._spawn(slot, app, sock)
+        sock.close()
+
+    def _spawn(self, slot, app, sock):
+        pid = os.fork()
+        if pid == 0:
+            # 子进程：恢复默认信号处理，父进程发 SIGTERM 时直接退出
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                self._run_worker(slot, app, sock)
+            finally:
+                os._exit(0)
+        self.children[pid] = (slot, time.monotonic())
+
+    def _run_worker(self, slot, app, sock):
+        torch.set_num_threads(self.threads)
+        if self.cpu_affinity and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, worker_cpus(slot, self.threads))
+        logging.info("--------Worker {} (pid {}) started, {} threads--------".format(slot, os.getpid(), self.threads))
+        server = make_server(self.host, self.port, app, threaded=True, fd=sock.fileno())
+        server.serve_forever()
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.children.clear()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/18 下午 03:40
+
+import os
+import argparse
+import logging
+
+import torch
+import torch.nn as nn
+
+import config
+from model import BertNER
+from data_loader import NERDataset, build_loader
+
+QUANTIZED_FILE = 'quantized_model.bin'
+
+
+def quantize_model(model):
+    """把所有 nn.Linear 动态量化为int8（权重int8，激活在运行时量化），CRF参数保持fp32"""
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_checkpoint(model_dir, quantized_dir=None):
+    """
+    把 train.train 保存的 checkpoint 量化后保存到 quantized_dir（默认 model_dir/int8/），
+    保存 config.json 和量化后的 state_dict
+    """
+    quantized_dir = quantized_dir or os.path.join(model_dir, config.quantized_dir_name)
+    os.makedirs(quantized_dir, exist_ok=True)
+    model = quantize_model(BertNER.from_pretrained(model_dir))
+    model.config.save_pretrained(quantized_dir)
+    torch.save(model.state_dict(), os.path.join(quantized_dir, QUANTIZED_FILE))
+    logging.info("--------Save int8 model to {}--------".format(quantized_dir))
+    return quantized_dir
+
+
+def load_quantized(quantized_dir):
+    """先按config构建fp32结构并量化，再加载量化后的权重"""
+    bert_config = BertNER.config_class.from_pretrained(quantized_dir)
+    model = quantize_model(BertNER(bert_config))
+    state_dict = torch.load(os.path.join(quantized_dir, QUANTIZED_FILE), map_location='cpu')
+    model.load_state_dict(state_dict)
+    return model
+
+
+def compare_f1(model_dir, quantized_dir=None):
+    """
+    在 run.load_dev 划分出的dev集上，用 metrics.f1_score 对比量化前后的f1
+    returns: (fp32 f1, int8 f1, 是否可以接受)
+    """
+    from run import load_dev
+    from train import evaluate
+
+    quantized_dir = quantized_dir or os.path.join(model_dir, config.quantized_dir_name)
+    _, word_dev, _, label_dev = load_dev('train')
+    dev_dataset = NERDataset(word_dev, label_dev, config)
+    dev_loader = build_loader(dev_dataset, config, workers=True)
+
+    fp32_f1 = evaluate(dev_loader, BertNER.from_pretrained(model_dir), mode='dev')['f1']
+    int8_f1 = evaluate(dev_loader, load_quantized(quantized_dir), mode='dev')['f1']
+    accept = fp32_f1 - int8_f1 <= config.max_quantized_f1_drop
+    logging.info("fp32 f1: {}, int8 f1: {}, f1 change: {}, {}".format(
+        fp32_f1, int8_f1, int8_f1 - fp32_f1, "accept" if accept else "reject"))
+    return fp32_f1, int8_f1, accept
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', default=config.model_dir)
+    parser.add_argument('--quantized_dir', default=None)
+    parser.add_argument('--skip_eval', action='store_true')
+    args = parser.parse_args()
+
+    quantize_checkpoint(args.model_dir, args.quantized_dir)
+    if not args.skip_eval:
+        compare_f1(args.model_dir, args.quantized_dir)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/18 下午 05:35
+
+import time
+import threading
+from collections import OrderedDict
+
+
+def normalize_sentence(chunk):
+    """
+    缓存key：chunk 为 GetData 处理后的字列表，key 与模型输入逐字对应；
+    不能合并或去掉空白，否则不同长度的输入会共用同一组标签
+    """
+    return ''.join(chunk)
+
+
+class ResultCache(object):
+    """
+    线程安全的 LRU 缓存，超过 max_size 时淘汰最久未使用的条目，超过 ttl 秒的条目视为失效
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self._data), 'max_size': self.max_size, 'ttl': self.ttl, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / total if total > 0 else 0.0}
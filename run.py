@@ -4,16 +4,18 @@
 
 import utils
 import config
+import model_registry
 import logging
 import numpy as np
 from data_process import Processor
-from data_loader import NERDataset
-from model import BertNER
+from data_loader import NERDataset, MmapNERDataset, build_loader
+from corpus import Corpus
+from model import BertNER, BertMultiHeadNER
 from train import train, evaluate
 from flask_data_process import GetData
 
 from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader
+from transformers import BertConfig
 from transformers.optimization import get_cosine_schedule_with_warmup, AdamW
 
 def dev_split(dataset_dir):
@@ -24,6 +26,17 @@ def dev_split(dataset_dir):
     x_train, x_dev, y_train, y_dev = train_test_split(words, labels, test_size=config.dev_split_size, random_state=0)
     return x_train, x_dev, y_train, y_dev
 
+def dev_split_indices(num):
+    """按下标划分验证集，与 dev_split 对同样条数的数据划分结果相同"""
+    idx_train, idx_dev = train_test_split(np.arange(num), test_size=config.dev_split_size, random_state=0)
+    return idx_train, idx_dev
+
+def load_mmap_dev():
+    """从二进制语料中划分训练集、验证集，不把数据读进内存"""
+    corpus = Corpus(config.data_dir + 'train_corpus/', config)
+    idx_train, idx_dev = dev_split_indices(len(corpus))
+    return MmapNERDataset(corpus, idx_train, config), MmapNERDataset(corpus, idx_dev, config)
+
 def load_dev(mode):
     if mode == 'train':
         # 分离出验证集
@@ -49,14 +62,11 @@ def test():
     test_dataset = NERDataset(word_test, label_test, config)
     logging.info("--------Dataset Build!--------")
     # build data_loader
-    test_loader = DataLoader(test_dataset, batch_size=config.batch_size,
-                             shuffle=False, collate_fn=test_dataset.collate_fn)
+    test_loader = build_loader(test_dataset, config, workers=True)
     logging.info("--------Get Data-loader!--------")
     # Prepare model
     if config.model_dir is not None:
-        model = BertNER.from_pretrained(config.model_dir)
-        model.to(config.device)
-        logging.info("--------Load model from {}--------".format(config.model_dir))
+        model = model_registry.get_model(config.model_dir)
     else:
         logging.info("--------No model to test !--------")
         return
@@ -71,30 +81,30 @@ def predict(content):
     data = GetData(content)
     text = data.preprocess()
     word_pre = text[0]
-    label_pre = text[1]
-    pre_dataset = NERDataset(word_pre,label_pre,config)
+    pre_dataset = NERDataset(word_pre, None, config)
     logging.info("--------Dataset Build!--------")
     # build data_loader
-    pre_loader = DataLoader(pre_dataset, batch_size=config.batch_size,
-                             shuffle=False, collate_fn=pre_dataset.collate_fn)
+    pre_loader = build_loader(pre_dataset, config)
     logging.info("--------Get Data-loader!--------")
 
     # Prepare model
 
+    # 多头模型一次前向同时给出 name/license 和 date/location
+    if config.multi_head:
+        model = model_registry.get_model(config.multi_head_dir, BertMultiHeadNER.from_pretrained)
+        pre_label = evaluate(pre_loader, model, mode='pre')['pre_labels']
+        return pre_label, pre_label
+
     # name/license
     if config.model_dir is not None:
-        model = BertNER.from_pretrained(config.model_dir)
-        model.to(config.device)
-        logging.info("--------Load model from {}--------".format(config.model_dir))
+        model = model_registry.get_serving_model(config.model_dir)
     else:
         logging.info("--------No model to predict !--------")
         return
 
     # date/location
     if config.model_dir1 is not None:
-        model1 = BertNER.from_pretrained(config.model_dir1)
-        model1.to(config.device)
-        logging.info("--------Load model from {}--------".format(config.model_dir1))
+        model1 = model_registry.get_serving_model(config.model_dir1)
     else:
         logging.info("--------No model to predict !--------")
         return
@@ -115,19 +125,19 @@ def run():
     processor = Processor(config)
     processor.process()
     logging.info("--------Process Done!--------")
-    # 分离出验证集
-    word_train, word_dev, label_train, label_dev = load_dev('train')
-    # build dataset
-    train_dataset = NERDataset(word_train, label_train, config)
-    dev_dataset = NERDataset(word_dev, label_dev, config)
+    # 分离出验证集，build dataset
+    if config.mmap_corpus:
+        train_dataset, dev_dataset = load_mmap_dev()
+    else:
+        word_train, word_dev, label_train, label_dev = load_dev('train')
+        train_dataset = NERDataset(word_train, label_train, config)
+        dev_dataset = NERDataset(word_dev, label_dev, config)
     logging.info("--------Dataset Build!--------")
     # get dataset size
     train_size = len(train_dataset)
     # build data_loader
-    train_loader = DataLoader(train_dataset, batch_size=config.batch_size,
-                              shuffle=True, collate_fn=train_dataset.collate_fn)
-    dev_loader = DataLoader(dev_dataset, batch_size=config.batch_size,
-                            shuffle=True, collate_fn=dev_dataset.collate_fn)
+    train_loader = build_loader(train_dataset, config, shuffle=True, workers=True)
+    dev_loader = build_loader(dev_dataset, config, shuffle=True, workers=True)
     logging.info("--------Get Dataloader!--------")
     # for x, y, z in train_loader:
     #     print("batch_data.shape: ", x.shape)
@@ -135,13 +145,23 @@ def run():
     #     print("batch_labels.shape: ", z.shape)
     # Prepare model
     device = config.device
-    model = BertNER.from_pretrained(config.roberta_model, num_labels=len(config.label2id))
+    if config.multi_head:
+        bert_config = BertConfig.from_pretrained(config.roberta_model)
+        bert_config.heads = config.heads
+        bert_config.ner_label2id = config.label2id
+        model = BertMultiHeadNER.from_pretrained(config.roberta_model, config=bert_config)
+        classifier, crf = model.classifiers, model.crfs
+        model_dir = config.multi_head_dir
+    else:
+        model = BertNER.from_pretrained(config.roberta_model, num_labels=len(config.label2id))
+        classifier, crf = model.classifier, model.crf
+        model_dir = config.model_dir
     model.to(device)
     # Prepare optimizer
     if config.full_fine_tuning:
         # model.named_parameters(): [bert, classifier, crf]
         bert_optimizer = list(model.bert.named_parameters())
-        classifier_optimizer = list(model.classifier.named_parameters())
+        classifier_optimizer = list(classifier.named_parameters())
         no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
         optimizer_grouped_parameters = [
             {'params': [p for n, p in bert_optimizer if not any(nd in n for nd in no_decay)],
@@ -152,11 +172,11 @@ def run():
              'lr': config.learning_rate * 5, 'weight_decay': config.weight_decay},
             {'params': [p for n, p in classifier_optimizer if any(nd in n for nd in no_decay)],
              'lr': config.learning_rate * 5, 'weight_decay': 0.0},
-            {'params': model.crf.parameters(), 'lr': config.learning_rate * 5}
+            {'params': crf.parameters(), 'lr': config.learning_rate * 5}
         ]
     # only fine-tune the head classifier
     else:
-        param_optimizer = list(model.classifier.named_parameters())
+        param_optimizer = list(classifier.named_parameters())
         optimizer_grouped_parameters = [{'params': [p for n, p in param_optimizer]}]
     optimizer = AdamW(optimizer_grouped_parameters, lr=config.learning_rate, correct_bias=False)
     train_steps_per_epoch = train_size // config.batch_size
@@ -166,7 +186,7 @@ def run():
 
     # Train the model
     logging.info("--------Start Training!--------")
-    train(train_loader, dev_loader, model, optimizer, scheduler, config.model_dir)
+    train(train_loader, dev_loader, model, optimizer, scheduler, model_dir)
 
 
     # 如果训练集不够，用这个计算分数.
@@ -177,6 +197,14 @@ def run():
     for label in config.labels:
         logging.info("f1 score of {}: {}".format(label, val_f1_labels[label]))
 
+
+def merge_heads():
+    """把 model_dir(name/license) 和 model_dir1(date/location) 合并成一个多头模型，保存到 multi_head_dir"""
+    model = BertMultiHeadNER.from_single_heads([config.model_dir, config.model_dir1], config.heads, config.label2id)
+    model.save_pretrained(config.multi_head_dir)
+    logging.info("--------Merged model saved to {}--------".format(config.multi_head_dir))
+
+
 if __name__ == '__main__':
     run()
     # test()
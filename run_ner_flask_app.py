@@ -3,6 +3,9 @@
 __author__ = liuxiangyu
 __mtime__ = 2020/11/26 14:33
 """
+import argparse
+import logging
+
 from flask import Flask
 
 
@@ -19,15 +22,29 @@ def run_as_blueprint():
 
     app.run(host='0.0.0.0', port=8989, debug=True)
 
-# def parse_arguments():
-#     parser = argparse.ArgumentParser()
-#     parser.add_argument('--port', action='store', help='App port number to run , default is 5000', type=str,
-#                         default=15000)
-#     parser.add_argument('--ip', action='store', help='Manuel assign ip address ,default is 0.0.0.0', type=str,
-#                         default="0.0.0.0")
-#     parser.add_argument('--debug', action='store', help='debug', default=False)
-#     return parser.parse_args()
+def run_prefork(args):
+    """生产环境：父进程加载一次模型，fork 出多个 worker 共享权重"""
+    from prefork_server import PreforkServer
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(process)d:%(levelname)s: %(message)s')
+    PreforkServer(host=args.ip, port=args.port, workers=args.workers, threads=args.threads).serve()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prefork', action='store_true', help='run the multi-process production server')
+    parser.add_argument('--port', action='store', help='App port number to run, default is config.serve_port', type=int,
+                        default=None)
+    parser.add_argument('--ip', action='store', help='Manuel assign ip address, default is config.serve_host', type=str,
+                        default=None)
+    parser.add_argument('--workers', action='store', help='number of worker processes', type=int, default=None)
+    parser.add_argument('--threads', action='store', help='torch threads per worker', type=int, default=None)
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    run_as_blueprint()
\ No newline at end of file
+    args = parse_arguments()
+    if args.prefork:
+        run_prefork(args)
+    else:
+        run_as_blueprint()
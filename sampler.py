@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/19 上午 11:10
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """
+    按token长度分桶的 batch sampler，让同一个batch内的句子长度接近，减少padding：
+        shuffle=True（训练）：随机打乱后每 bucket_size 个样本为一个桶，桶内按长度排序切成batch，再打乱所有batch
+        shuffle=False（预测）：全部按长度排序，结果可以用 restore 恢复成原始顺序
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=None, seed=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size or batch_size * 50
+        self.rng = np.random.default_rng(seed)
+        self.batches = []
+
+    def _make_batches(self):
+        if self.shuffle:
+            indices = self.rng.permutation(len(self.lengths))
+            buckets = [indices[i:i + self.bucket_size] for i in range(0, len(indices), self.bucket_size)]
+        else:
+            buckets = [np.arange(len(self.lengths))]
+        batches = []
+        for bucket in buckets:
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        self.batches = self._make_batches()
+        return iter(self.batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def order(self):
+        """最近一次迭代中样本的顺序"""
+        return [idx for batch in self.batches for idx in batch]
+
+    def restore(self, results):
+        """把按迭代顺序得到的结果恢复成数据集原始顺序"""
+        restored = [None] * len(results)
+        for result, idx in zip(results, self.order()):
+            restored[idx] = result
+        return restored
+
+    def padding_ratio(self):
+        """最近一次迭代中padding token占全部token的比例"""
+        total = 0
+        padding = 0
+        for batch in self.batches:
+            lengths = self.lengths[batch]
+            total += lengths.max() * len(batch)
+            padding += lengths.max() * len(batch) - lengths.sum()
+        return float(padding) / total if total > 0 else 0.0
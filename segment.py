@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# __author : Bossun_Chen
+# __time : 2026/10/19 上午 09:20
+
+import re
+
+import config
+
+# 句末标点：优先在这些字符之后切分，标点保留在前一段末尾
+SENTENCE_END = re.compile(r'[。！？；!?;\n]')
+# 句子超过上限时，退而在这些字符之后切分
+SOFT_END = set('，,、：:')
+
+
+def segment(text, max_len=None, tags=None):
+    """
+    按句末标点把 text 切成不超过 max_len 的若干段，返回每段在 text 中的 (start, end)
+    params:
+        text: 字符串，或每个元素为单个字符的列表
+        max_len: 每段最大长度，默认 config.max_segment_len
+        tags: 与 text 等长的BIO标签，训练数据切分时传入，避免把实体切断
+    examples:
+        segment('发热。到达广州，入住酒店', max_len=5) -> [(0, 3), (3, 8), (8, 12)]
+    """
+    max_len = max_len or config.max_segment_len
+    # 也接受按字切分好的列表
+    if not isinstance(text, str):
+        text = ''.join(text)
+    offsets = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        # 标点在实体内部（下一个字仍是 I- 标签）时不切分
+        if _inside_entity(tags, match.end()):
+            continue
+        offsets.extend(_split_long(text, start, match.end(), max_len, tags))
+        start = match.end()
+    offsets.extend(_split_long(text, start, len(text), max_len, tags))
+    return offsets
+
+
+def slices(seq, offsets):
+    """按 segment 的结果切分字符串或标签列表"""
+    return [seq[start:end] for start, end in offsets]
+
+
+def _split_long(text, start, end, max_len, tags):
+    offsets = []
+    while end - start > max_len:
+        cut = _cut_point(text, start, start + max_len, tags)
+        offsets.append((start, cut))
+        start = cut
+    if end > start:
+        offsets.append((start, end))
+    return offsets
+
+
+def _inside_entity(tags, i):
+    return tags is not None and i < len(tags) and tags[i].startswith('I-')
+
+
+def _cut_point(text, start, limit, tags):
+    """在 (start, limit] 内从后往前找切分位置：软标点之后 > 实体边界 > 硬切"""
+    for i in range(limit, start, -1):
+        if text[i - 1] in SOFT_END and not _inside_entity(tags, i):
+            return i
+    if tags is not None:
+        for i in range(limit, start, -1):
+            if not _inside_entity(tags, i):
+                return i
+    return limit
@@ -4,13 +4,16 @@
 
 import torch
 import logging
+import numpy as np
 import torch.nn as nn
 from tqdm import tqdm
 
+import utils
 import config
-from model import BertNER
-from metrics import f1_score, bad_case, pre_label
-from transformers import BertTokenizer
+from metrics import f1_score_ids, flatten_ids, bad_case, pre_label
+from decoder import to_tag_lists
+from sampler import BucketBatchSampler
+from data_loader import to_device
 
 
 def train_epoch(train_loader, model, optimizer, scheduler, epoch):
@@ -19,10 +22,10 @@ def train_epoch(train_loader, model, optimizer, scheduler, epoch):
     # step number in one epoch: 336
     train_losses = 0
     for idx, batch_samples in enumerate(tqdm(train_loader)):
-        batch_data, batch_token_starts, batch_labels = batch_samples
+        batch_data, batch_token_starts, batch_labels, _, batch_packing = to_device(batch_samples, config.device)
         batch_masks = batch_data.gt(0)  # get padding mask
         # compute model output and loss
-        loss = model((batch_data, batch_token_starts),
+        loss = model((batch_data, batch_token_starts, batch_packing),
                      token_type_ids=None, attention_mask=batch_masks, labels=batch_labels)[0]
         train_losses += loss.item()
         # clear previous gradients, compute gradients of all variables wrt loss
@@ -35,13 +38,15 @@ def train_epoch(train_loader, model, optimizer, scheduler, epoch):
         scheduler.step()
     train_loss = float(train_losses) / len(train_loader)
     logging.info("Epoch: {}, train loss: {}".format(epoch, train_loss))
+    if isinstance(train_loader.batch_sampler, BucketBatchSampler):
+        logging.info("Epoch: {}, padding ratio: {:.4f}".format(epoch, train_loader.batch_sampler.padding_ratio()))
 
 
 def train(train_loader, dev_loader, model, optimizer, scheduler, model_dir):
     """train the model and test model performance"""
     # reload weights from restore_dir if specified
     if model_dir is not None and config.load_before:
-        model = BertNER.from_pretrained(model_dir)
+        model = model.__class__.from_pretrained(model_dir)
         model.to(config.device)
         logging.info("--------Load model from {}--------".format(model_dir))
     best_val_f1 = 0.0
@@ -70,72 +75,108 @@ def train(train_loader, dev_loader, model, optimizer, scheduler, model_dir):
     logging.info("Training Finished!")
 
 
+def infer(pre_loader, model):
+    """inference only: one forward pass and CRF decode per batch, no loss and no labels"""
+    model.eval()
+    _, id2label = utils.get_label_maps(config.label2id)
+    pred_tags = []
+    sent_data = []
+    with torch.inference_mode():
+        for idx, batch_samples in enumerate(pre_loader):
+            batch_data, batch_token_starts, _, batch_original_contents, batch_packing = \
+                to_device(batch_samples, config.device)
+            # 可以返回原字样
+            sent_data.extend(batch_original_contents)
+            batch_masks = batch_data.gt(0)  # get padding mask
+            # (batch_size, label_len)
+            batch_output = model.decode((batch_data, batch_token_starts, batch_packing),
+                                        token_type_ids=None, attention_mask=batch_masks)
+            pred_tags.extend([[id2label.get(idx) for idx in indices] for indices in to_tag_lists(batch_output)])
+    return restore_order(pre_loader, pred_tags), restore_order(pre_loader, sent_data)
+
+
+def restore_order(loader, results):
+    """按长度分桶时，把结果恢复成数据集的原始顺序"""
+    if isinstance(loader.batch_sampler, BucketBatchSampler):
+        return loader.batch_sampler.restore(results)
+    return results
+
+
 def evaluate(dev_loader, model, mode='dev'):
+    if mode == 'pre':
+        pred_tags, sent_data = infer(dev_loader, model)
+        metrics = {}
+        metrics['pre_labels'] = pre_label(pred_tags, sent_data)
+        # 按chunk返回，供批量预测按记录拆分结果
+        metrics['pred_tags'] = pred_tags
+        metrics['sent_data'] = sent_data
+        return metrics
+
     # set model to evaluation mode
     model.eval()
     if mode == 'test':
-        tokenizer = BertTokenizer.from_pretrained(config.bert_model, do_lower_case=True, skip_special_tokens=True)
-    if mode == 'pre':
-        tokenizer = BertTokenizer.from_pretrained(config.bert_model, do_lower_case=True, skip_special_tokens=True)
-    id2label = config.id2label
+        tokenizer = utils.get_tokenizer(config.bert_model)
+    _, id2label = utils.get_label_maps(config.label2id)
     true_tags = []
     pred_tags = []
     sent_data = []
+    # 一维标签id数组，直接用于计算f1
+    true_ids = []
+    pred_ids = []
     dev_losses = 0
 
     with torch.no_grad():
         for idx, batch_samples in enumerate(dev_loader):
-            batch_data, batch_token_starts, batch_tags, batch_original_contents = batch_samples
-            print("batch_original_contents:",batch_original_contents)
-            print("batch_data:",batch_data)
-            print("batch_data:",batch_data[0])
+            batch_data, batch_token_starts, batch_tags, batch_original_contents, batch_packing = \
+                to_device(batch_samples, config.device)
 
-            if mode == 'test':
+            if mode == 'test' and batch_packing is None:
                 sent_data.extend([[tokenizer.convert_ids_to_tokens(idx.item()) for idx in indices
                                    if (idx.item() > 0 and idx.item() != 101)] for indices in batch_data])
-            elif mode == 'pre':
-                # 可以返回原字样
-                sent_data.extend([[idx for idx in indices] for indices in batch_original_contents])
-
-                # 以id to token 返回UNK
-                # sent_data.extend([[tokenizer.convert_ids_to_tokens(idx.item()) for idx in indices
-                #                    if (idx.item() > 0 and idx.item() != 101)] for indices in batch_data])
-                # print(sent_data)
+            elif mode == 'test':
+                # pack模式下一行有多句，直接用原文
+                sent_data.extend(batch_original_contents)
 
             batch_masks = batch_data.gt(0)  # get padding mask, gt(x): get index greater than x
             label_masks = batch_tags.gt(-1)  # get padding mask, gt(x): get index greater than x
-            # compute model output and loss
-            loss = model((batch_data, batch_token_starts),
-                         token_type_ids=None, attention_mask=batch_masks, labels=batch_tags)[0]
+            batch_tags = model.restrict_labels(batch_tags)
+            # 一次前向同时得到loss和logits: (batch_size, max_len, num_labels)
+            loss, batch_output = model((batch_data, batch_token_starts, batch_packing),
+                                       token_type_ids=None, attention_mask=batch_masks, labels=batch_tags)[:2]
             dev_losses += loss.item()
-            # (batch_size, max_len, num_labels)
-            batch_output = model((batch_data, batch_token_starts),
-                                 token_type_ids=None, attention_mask=batch_masks)[0]
-            # (batch_size, max_len - padding_label_len)
-            batch_output = model.crf.decode(batch_output, mask=label_masks)
+            # (batch_size, max_len)，padding为-1
+            batch_output = model.decode_emissions(batch_output, label_masks)
+            if torch.is_tensor(batch_output):
+                batch_output = batch_output.cpu().numpy()
             # (batch_size, max_len)
             batch_tags = batch_tags.to('cpu').numpy()
-            pred_tags.extend([[id2label.get(idx) for idx in indices] for indices in batch_output])
-            # (batch_size, max_len - padding_label_len)
-            true_tags.extend([[id2label.get(idx) for idx in indices if idx > -1] for indices in batch_tags])
+            pred_ids.append(flatten_ids(batch_output))
+            true_ids.append(flatten_ids(batch_tags))
+            if mode == 'test':
+                # bad case 需要标签字符串
+                pred_tags.extend([[id2label.get(idx) for idx in indices] for indices in to_tag_lists(batch_output)])
+                # (batch_size, max_len - padding_label_len)
+                true_tags.extend([[id2label.get(idx) for idx in indices if idx > -1] for indices in batch_tags])
 
-    assert len(pred_tags) == len(true_tags)
+    true_ids = np.concatenate(true_ids)
+    pred_ids = np.concatenate(pred_ids)
     if mode == 'test':
+        assert len(pred_tags) == len(true_tags)
+        pred_tags = restore_order(dev_loader, pred_tags)
+        true_tags = restore_order(dev_loader, true_tags)
+        sent_data = restore_order(dev_loader, sent_data)
         assert len(sent_data) == len(true_tags)
 
     # logging loss, f1 and report
     metrics = {}
     if mode == 'dev':
-        f1 = f1_score(true_tags, pred_tags, mode)
+        f1 = f1_score_ids(true_ids, pred_ids, id2label, mode)
         metrics['f1'] = f1
-    elif mode == 'test':
+    else:
         bad_case(true_tags, pred_tags, sent_data)
-        f1_labels, f1 = f1_score(true_tags, pred_tags, mode)
+        f1_labels, f1 = f1_score_ids(true_ids, pred_ids, id2label, mode)
         metrics['f1_labels'] = f1_labels
         metrics['f1'] = f1
-    else:
-        pre_labels = pre_label(pred_tags, sent_data)
-        metrics['pre_labels'] = pre_labels
     metrics['loss'] = float(dev_losses) / len(dev_loader)
     return metrics
 
@@ -147,7 +188,7 @@ if __name__ == "__main__":
          4413, 4638, 2767, 738, 976, 4638, 3683, 6772, 1962, 511, 0, 0,
          0, 0, 0]
     t = torch.tensor(a, dtype=torch.long)
-    tokenizer = BertTokenizer.from_pretrained(config.bert_model, do_lower_case=True, skip_special_tokens=True)
+    tokenizer = utils.get_tokenizer(config.bert_model)
     word = tokenizer.convert_ids_to_tokens(t[1].item())
     sent = tokenizer.decode(t.tolist())
     print(word)
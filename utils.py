@@ -3,6 +3,10 @@
 # __time : 2021/11/22 下午 12:36
 
 import logging
+import threading
+
+import numpy as np
+from transformers import BertTokenizer
 
 
 def set_logger(log_path):
@@ -28,4 +32,95 @@ def set_logger(log_path):
         # Logging to console
         stream_handler = logging.StreamHandler()
         stream_handler.setFormatter(logging.Formatter('%(message)s'))
-        logger.addHandler(stream_handler)
\ No newline at end of file
+        logger.addHandler(stream_handler)
+
+_tokenizers = {}
+_label_maps = {}
+_char_vocabs = {}
+_registry_lock = threading.Lock()
+# 进程内实际从磁盘加载词表的次数
+tokenizer_loads = 0
+
+
+def get_tokenizer(bert_model):
+    """Return the process-wide BertTokenizer for `bert_model`, loading the vocab from disk only once.
+
+    Args:
+        bert_model: (string) directory of the pretrained bert vocab
+    """
+    global tokenizer_loads
+    with _registry_lock:
+        tokenizer = _tokenizers.get(bert_model)
+        if tokenizer is None:
+            tokenizer = BertTokenizer.from_pretrained(bert_model, do_lower_case=True, skip_special_tokens=True)
+            _tokenizers[bert_model] = tokenizer
+            tokenizer_loads += 1
+            logging.info("--------Load tokenizer from {} (loads: {})--------".format(bert_model, tokenizer_loads))
+    return tokenizer
+
+
+def get_label_maps(label2id):
+    """Return the shared (label2id, id2label) pair built from `label2id`."""
+    key = tuple(label2id.items())
+    with _registry_lock:
+        maps = _label_maps.get(key)
+        if maps is None:
+            maps = (dict(label2id), {_id: _label for _label, _id in label2id.items()})
+            _label_maps[key] = maps
+    return maps
+
+
+class CharVocab(object):
+    """
+    按字查表的编码器：每个不同的字只调用一次 tokenizer.tokenize（小写、去重音、[UNK] 等规则与
+    BertTokenizer 完全一致），结果记在表中，整篇文档用 np.unique 一次查表得到所有id
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        # 字 -> 该字tokenize后的id，绝大多数字对应一个id，空白等字符为空元组
+        self.table = {}
+
+    def lookup(self, token):
+        ids = self.table.get(token)
+        if ids is None:
+            ids = tuple(self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(token)))
+            self.table[token] = ids
+        return ids
+
+    def encode(self, tokens):
+        """与 convert_tokens_to_ids(sum(tokenize(t) for t in tokens)) 相同，不含[CLS]"""
+        if len(tokens) == 0:
+            return np.zeros(0, dtype=np.int64)
+        uniques, inverse = np.unique(np.asarray(tokens), return_inverse=True)
+        ids = [self.lookup(token) for token in uniques.tolist()]
+        if all(len(token_ids) == 1 for token_ids in ids):
+            return np.array([token_ids[0] for token_ids in ids], dtype=np.int64)[inverse]
+        # 有字被拆成多个子词或被丢弃时按顺序拼接
+        return np.array([idx for i in inverse for idx in ids[i]], dtype=np.int64)
+
+    def encode_aligned(self, tokens):
+        """
+        逐字对齐的编码，returns: (ids, starts)，starts[i] 为第i个字的第一个子词在 ids 中的位置（不含[CLS]）；
+        空白等 tokenize 后为空的字编码为 [UNK]，保证每个字都有自己的位置，标签不会错位
+        """
+        if len(tokens) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        uniques, inverse = np.unique(np.asarray(tokens), return_inverse=True)
+        ids = [self.lookup(token) or (self.tokenizer.unk_token_id,) for token in uniques.tolist()]
+        lens = np.array([len(token_ids) for token_ids in ids], dtype=np.int64)[inverse]
+        starts = np.cumsum(lens) - lens
+        if (lens == 1).all():
+            return np.array([token_ids[0] for token_ids in ids], dtype=np.int64)[inverse], starts
+        return np.array([idx for i in inverse for idx in ids[i]], dtype=np.int64), starts
+
+
+def get_char_vocab(bert_model):
+    """Return the process-wide CharVocab built on the shared tokenizer of `bert_model`."""
+    tokenizer = get_tokenizer(bert_model)
+    with _registry_lock:
+        vocab = _char_vocabs.get(bert_model)
+        if vocab is None:
+            vocab = CharVocab(tokenizer)
+            _char_vocabs[bert_model] = vocab
+    return vocab